@@ -0,0 +1,258 @@
+"""Offline benchmark for the scrape cycle.
+
+Replays saved or synthetic OLX search pages through a local HTTP server and
+times extraction, matching, dedup, persistence and a full OLXScraper.scrape
+run with a fake Telegram bot.
+
+Usage:
+    python benchmark.py                      # run and compare with the baseline
+    python benchmark.py --save-baseline      # store the current results as the baseline
+    python benchmark.py --pages saved_pages  # also replay saved *.html pages
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import scraper
+
+BASELINE_FILE = "benchmark_baseline.json"
+CARD_COUNTS = [30, 300, 1000, 5000]
+MODEL_COUNTS = [5, 50]
+REPEATS = 5
+TOLERANCE = 0.25  # Allowed p95 slowdown over the baseline
+
+MODEL_NAMES = [
+    "iPhone 11", "iPhone 11 Pro", "iPhone 12", "iPhone 12 mini", "iPhone 12 Pro",
+    "iPhone 13", "iPhone 13 mini", "iPhone 13 Pro", "iPhone 13 Pro Max", "iPhone 14",
+    "iPhone 14 Plus", "iPhone 14 Pro", "iPhone 15", "iPhone 15 Pro", "iPhone SE"
+]
+TITLE_NOISE = ["128GB", "256GB", "stan idealny", "bateria 89%", "etui gratis", "uszkodzony", "jak nowy"]
+CITIES = ["Warszawa", "Kraków", "Gdańsk", "Poznań", "Wrocław", "Łódź"]
+
+
+class FakeBot:
+    """Stands in for telegram.Bot and records sent messages."""
+
+    def __init__(self):
+        self.messages = []
+
+    async def send_message(self, **kwargs):
+        self.messages.append(kwargs)
+
+
+def generate_page(card_count, seed=0):
+    """Build a synthetic OLX search page with the given number of cards."""
+    rng = random.Random(seed)
+    cards = []
+    for i in range(card_count):
+        post_id = f"{seed}x{i}"
+        title = f"{rng.choice(MODEL_NAMES)} {rng.choice(TITLE_NOISE)}"
+        price = rng.randint(300, 6000)
+        cards.append(
+            f'<div data-cy="l-card" id="{i}">'
+            f'<a href="/d/oferta/iphone-ID{post_id}.html"><img src="x.jpg">'
+            f'<h6>{title}</h6></a>'
+            f'<p data-testid="ad-price">{price // 1000} {price % 1000:03d} zł</p>'
+            f'<p data-testid="location-date">{rng.choice(CITIES)} - Dzisiaj o 12:{i % 60:02d}</p>'
+            f'</div>'
+        )
+    return "<html><body>" + "\n".join(cards) + "</body></html>"
+
+
+def generate_models(count):
+    """Tracked model list of the given size, half of them with a price limit."""
+    models = []
+    for i in range(count):
+        name = MODEL_NAMES[i % len(MODEL_NAMES)]
+        if i >= len(MODEL_NAMES):
+            name += f" {TITLE_NOISE[i % len(TITLE_NOISE)]}"
+        models.append({"model": name, "max_price": 3000} if i % 2 else name)
+    return models
+
+
+def start_server(pages):
+    """Serve {path: html} from a local HTTP server, returning (server, base_url)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = pages.get(urlparse(self.path).path, "").encode("utf-8")
+            self.send_response(200 if body else 404)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+async def selenium_disabled(url, previous=None):
+    raise RuntimeError("HTTP parse failed and the Selenium fallback is disabled offline")
+
+
+def quiet():
+    """Silence the scraper's progress prints while timing."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples, items):
+    """p50/p95 in milliseconds and throughput in items per second."""
+    return {
+        "p50_ms": percentile(samples, 0.5) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "items_per_s": items / statistics.mean(samples) if statistics.mean(samples) else 0
+    }
+
+
+async def run_scrape(base_url, models, workdir):
+    """Run one full scrape cycle against the local server with a fake bot."""
+    state = scraper.StateStore(
+        os.path.join(workdir, "models.json"), os.path.join(workdir, "status.json"), write_delay=0
+    )
+    store = scraper.SeenPostsStore(os.path.join(workdir, f"seen_{time.time_ns()}.db"))
+    olx = scraper.OLXScraper(base_url=base_url, fetch_backend="http", state=state)
+    olx.fetch_posts_selenium = selenium_disabled
+    # The worker is not started: delivery is rate limited and runs outside the cycle
+    notifier = scraper.NotificationDispatcher(FakeBot(), store, chat_id=1)
+
+    status = json.loads(json.dumps(scraper.DEFAULT_STATUS))
+    started = time.perf_counter()
+    with quiet():
+        success = await olx.scrape(notifier, models, store, status)
+    elapsed = time.perf_counter() - started
+
+    await olx.close()
+    store.close()
+    if not success:
+        raise RuntimeError("scrape failed")
+    return elapsed
+
+
+def bench_case(name, html, base_url, models, workdir, repeats):
+    """Time every stage for one page and model list."""
+    timings = {stage: [] for stage in ("extraction", "matching", "dedup", "persistence", "scrape")}
+    posts = []
+
+    for _ in range(repeats):
+        started = time.perf_counter()
+        posts = scraper.OLXScraper.build_posts(scraper.HTTPFetcher.parse(html, base_url))
+        timings["extraction"].append(time.perf_counter() - started)
+
+        rules = scraper.RuleEngine(models)
+        started = time.perf_counter()
+        with quiet():
+            matches = [post for post, rule in rules.evaluate(posts)]
+        timings["matching"].append(time.perf_counter() - started)
+
+        store = scraper.SeenPostsStore(os.path.join(workdir, f"dedup_{time.time_ns()}.db"))
+        # Pretend half of the page was seen before
+        for post in posts[::2]:
+            store.add(post["id"], {"link": post["link"], "title": post["title"]})
+        store.flush()
+        started = time.perf_counter()
+        fresh = [post for post in posts if post["id"] not in store and not store.has_link(post["link"])]
+        timings["dedup"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for post in matches:
+            store.enqueue_notification(post["id"], 1, post["title"], {"link": post["link"], "title": post["title"]})
+        store.mark_delivered([post["id"] for post in matches])
+        store.flush()
+        timings["persistence"].append(time.perf_counter() - started)
+        store.close()
+
+        timings["scrape"].append(asyncio.run(run_scrape(base_url, models, workdir)))
+
+    results = {stage: summarize(samples, len(posts)) for stage, samples in timings.items()}
+    print(f"\n{name}: {len(posts)} cards, {len(models)} models, {len(fresh)} unseen, {len(matches)} matches")
+    for stage, result in results.items():
+        print(f"  {stage:<12} p50 {result['p50_ms']:9.2f} ms   p95 {result['p95_ms']:9.2f} ms   "
+              f"{result['items_per_s']:12.0f} cards/s")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of stages whose p95 regressed past the baseline."""
+    regressions = []
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(case, {}).get(stage)
+            if reference and result["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{case} / {stage}: p95 {result['p95_ms']:.2f} ms > baseline {reference['p95_ms']:.2f} ms"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OLX scrape cycle offline.")
+    parser.add_argument("--pages", help="Directory with saved OLX search result pages (*.html)")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    pages = {f"/synthetic-{count}": generate_page(count, seed=count) for count in CARD_COUNTS}
+    if args.pages:
+        for file_name in sorted(os.listdir(args.pages)):
+            if file_name.endswith(".html"):
+                with open(os.path.join(args.pages, file_name), encoding="utf-8") as file:
+                    pages[f"/saved-{file_name}"] = file.read()
+
+    server, server_url = start_server(pages)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for path, html in pages.items():
+                for model_count in MODEL_COUNTS:
+                    name = f"{path.lstrip('/')} x {model_count} models"
+                    results[name] = bench_case(
+                        name, html, server_url + path, generate_models(model_count), workdir, args.repeats
+                    )
+    finally:
+        server.shutdown()
+
+    if args.save_baseline:
+        scraper.JSONHandler.save(args.baseline, results)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+
+    regressions = compare(results, scraper.JSONHandler.load(args.baseline), args.tolerance)
+    if regressions:
+        print("\n❌ Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+
+    print("\n✅ No regressions against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
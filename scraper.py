@@ -1,18 +1,73 @@
+from __future__ import annotations
+
 import logging
+import math
 import os
 import re
 import json
+import sqlite3
+import struct
+import sys
+import time
+import zlib
 from datetime import datetime
+import argparse
 import asyncio
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from webdriver_manager.chrome import ChromeDriverManager
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+import bisect
+import contextlib
+import functools
+import hashlib
+from collections import OrderedDict
+import random
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+import httpx
+# Selenium, webdriver_manager, python-telegram-bot and numpy are slow to import and
+# only loaded when needed, see import_selenium(), import_telegram() and import_numpy()
+np = None
+
+# Startup time is reported relative to this
+STARTED_AT = time.monotonic()
+
+def import_selenium():
+    """Import Selenium on first use; the HTTP backend may never need it."""
+    global webdriver, Options, By, Service, WebDriverWait, EC, TimeoutException, ChromeDriverManager
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+    from webdriver_manager.chrome import ChromeDriverManager
+
+
+def import_numpy():
+    """Import numpy when rules are first evaluated; False when it isn't installed."""
+    global np
+    if np is None:
+        try:
+            import numpy as np
+        except ImportError:  # Rules are then evaluated post by post
+            np = False
+    return np
+
+
+def import_telegram():
+    """Import python-telegram-bot when the bot or a worker starts; --replay doesn't need it."""
+    global Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, BadRequest, RetryAfter
+    global Application, CommandHandler, CallbackQueryHandler, ContextTypes
+    from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.error import BadRequest, RetryAfter
+    from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+
 
 # Configure logging
 logging.basicConfig(
@@ -21,17 +76,219 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Telegram Bot credentials
-BOT_TOKEN = 
-CHAT_ID = 
+# Telegram Bot credentials, from the BOT_TOKEN and CHAT_ID environment variables
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
+CHAT_ID = os.environ.get("CHAT_ID", "")
 
 # Base URL for scraping
 BASE_URL = "https://www.olx.pl/elektronika/telefony/smartfony-telefony-komorkowe/iphone/?search%5Border%5D=created_at:desc"
 
+# Page fetch backend: "http" parses the page without a browser and falls back
+# to Selenium when that fails, "selenium" always uses the headless browser
+FETCH_BACKEND = "http"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+# Stage timings kept per stage for /metrics; set METRICS_PORT to also serve
+# them in Prometheus text format on localhost
+METRICS_SAMPLES = 200
+METRICS_PORT = None
+
+# Detail page enrichment: fetch candidate matches' own pages to read storage,
+# condition and description, and drop accessories and damaged phones
+ENRICH_DETAILS = False
+ENRICH_WORKERS = 4
+
+# Scrape pipeline: pages waiting for matching, and matches waiting for notification
+PIPELINE_PAGE_QUEUE = 2
+PIPELINE_QUEUE_SIZE = 20
+DETAIL_CACHE_SIZE = 2000
+DETAIL_CACHE_TTL = 6 * 3600
+ACCESSORY_KEYWORDS = ["etui", "case", "szkło", "szklo", "folia", "obudowa", "ładowarka", "ladowarka",
+                      "kabel", "pudełko", "pudelko", "pokrowiec", "uchwyt"]
+# A title with an accessory keyword is an accessory, unless the keyword only lists
+# extras of the phone: after one of these ("iPhone 13 + etui, szkło", "w zestawie etui"),
+# followed by one in the same clause ("etui gratis"), or right after "w"/"bez"
+# ("zawsze w etui", "bez etui")
+ACCESSORY_EXTRAS_BEFORE = ["+", "z", "ze", "plus", "oraz", "dodatkowo", "w zestawie", "w komplecie"]
+ACCESSORY_EXTRAS_AFTER = ["gratis", "gratisowo", "w zestawie", "w komplecie"]
+ACCESSORY_IN_USE = ["w", "bez"]
+DAMAGE_KEYWORDS = ["uszkodzony", "uszkodzone", "zbity", "zbita", "pęknięty", "pekniety", "broken",
+                   "na części", "na czesci", "nie działa", "nie dziala", "blokada icloud"]
+# A damage keyword is denied when one of these comes up to two words before it
+# in the same clause ("nigdy nie zbity"), or the word after it flips it ("nie działa źle")
+DAMAGE_NEGATIONS = ["nie", "nigdy", "bez", "ani"]
+DAMAGE_NEGATIONS_AFTER = ["źle", "zle"]
+
+# Price history: every scraped listing is appended to daily segment files and
+# per-model price percentiles over the last PRICE_HISTORY_DAYS are kept in memory
+PRICE_HISTORY_DIR = "price_history"
+PRICE_HISTORY_DAYS = 30
+PRICE_MIN_SAMPLES = 10  # Listings of a model needed before alerts get a deal score
+
+# Optional record/replay archive: each cycle's cards are appended, compressed,
+# to daily segments in ARCHIVE_DIR so rules can be backtested with --replay
+ARCHIVE_DIR = None
+REPLAY_CHUNK_CYCLES = 200  # Cycles per replay task handed to a worker process
+
+# Blocking Selenium calls run on this many dedicated threads, off the event loop
+BROWSER_WORKERS = 1
+PAGE_LOAD_TIMEOUT = 30
+
+# Lean browsing: only the document and OLX's own scripts are loaded; the cards
+# are read from the DOM, so images, media, fonts, CSS and trackers are blocked
+LEAN_BROWSER = True
+BROWSER_BLOCKED_URLS = [
+    "*.jpg", "*.jpeg", "*.png", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.css", "*.mp4", "*.webm",
+    "*apollo.olxcdn.com*", "*googletagmanager.com*", "*google-analytics.com*", "*doubleclick.net*",
+    "*googlesyndication.com*", "*facebook.net*", "*hotjar.com*", "*criteo.com*", "*onetrust.com*",
+    "*cookielaw.org*", "*adnxs.com*", "*gemius.pl*", "*nr-data.net*"
+]
+# After scrolling, wait until the number of cards stops growing
+CARD_WAIT_TIMEOUT = 5
+CARD_WAIT_POLL = 0.25
+
+# Number of recent response times kept per bot command
+LATENCY_SAMPLES = 50
+
+# Chrome is restarted after this many cycles or when its processes use more memory
+BROWSER_MAX_CYCLES = 50
+# The resolved chromedriver path is kept here, so restarts don't need the network
+DRIVER_PATH_FILE = ".chromedriver_path.json"
+BROWSER_MAX_RSS_MB = 800
+
+# Notification delivery: Telegram allows about one message per second per chat
+# and 30 per second overall
+CHAT_MESSAGES_PER_SECOND = 1
+GLOBAL_MESSAGES_PER_SECOND = 30
+NOTIFICATION_MAX_RETRIES = 5
+NOTIFICATION_BACKOFF = 2  # Seconds, doubled after every failed attempt
+# After NOTIFICATION_MAX_RETRIES failed attempts a notification goes back on the
+# queue after NOTIFICATION_REQUEUE_DELAY, doubled each time up to the max
+NOTIFICATION_REQUEUE_DELAY = 60
+NOTIFICATION_REQUEUE_MAX_DELAY = 3600
+DIGEST_WINDOW = 0  # Seconds to collect a burst of matches into one message, 0 disables
+DIGEST_MAX_ITEMS = 10
+
+# Adaptive polling: aim for about TARGET_NEW_POSTS per cycle, within these bounds.
+# At the 1-2 new iPhone listings a minute of a normal day that is about the
+# fixed 120 s this replaced; quiet hours back off to MAX_CHECK_INTERVAL at most
+MIN_CHECK_INTERVAL = 30
+MAX_CHECK_INTERVAL = 300
+TARGET_NEW_POSTS = 3
+POLL_JITTER = 0.1  # +/- fraction of the interval
+RATE_SMOOTHING = 0.3  # Weight of the newest sample in the per-hour rate average
+
+# Transferred bytes (document plus subresources) and load time of the current page
+PAGE_TRANSFER_SCRIPT = """
+var navigation = performance.getEntriesByType("navigation")[0];
+var resources = performance.getEntriesByType("resource");
+var bytes = navigation ? navigation.transferSize : 0;
+resources.forEach(function (entry) { bytes += entry.transferSize || 0; });
+return {
+    bytes: bytes,
+    requests: resources.length + 1,
+    load_ms: navigation ? (navigation.loadEventEnd || performance.now()) - navigation.startTime : performance.now()
+};
+"""
+
+# Links of the first N listing cards that are not promoted, for the page fingerprint
+FIRST_LINKS_SCRIPT = """
+return Array.from(document.querySelectorAll("[data-cy='l-card']"))
+    .filter(function (card) { return !card.querySelector("[data-testid='adCard-featured']"); })
+    .slice(0, arguments[0])
+    .map(function (card) { var link = card.querySelector("a"); return link ? link.href : ""; });
+"""
+
+# Collects every listing card in a single WebDriver round trip
+EXTRACT_CARDS_SCRIPT = """
+return Array.from(document.querySelectorAll("[data-cy='l-card']")).map(function (card) {
+    var link = card.querySelector("a");
+    var title = card.querySelector("h4, h6");
+    var price = card.querySelector("p[data-testid='ad-price']");
+    var locationTime = card.querySelector("p[data-testid='location-date']");
+    return {
+        card_id: card.id || null,
+        link: link ? link.href : null,
+        title: title ? title.innerText.trim() : null,
+        price_text: price ? price.innerText.trim() : null,
+        location_time: locationTime ? locationTime.innerText : null,
+        promoted: !!card.querySelector("[data-testid='adCard-featured']")
+    };
+});
+"""
+
 # File paths
 MODELS_FILE = "iphone_models.json"
-SEEN_POSTS_FILE = "seen_posts.json"
-STATUS_FILE = "bot_status.json"
+SEEN_POSTS_FILE = "seen_posts.json"  # Legacy format, migrated into SEEN_POSTS_DB
+SEEN_POSTS_DB = "seen_posts.db"
+SEEN_POSTS_TTL_DAYS = 90
+# WAL needs shared memory, so use "DELETE" when workers on several machines
+# share the database over a network filesystem
+SEEN_POSTS_JOURNAL_MODE = "WAL"
+# Seconds a write waits for another connection's lock before it fails and is
+# retried later (flush keeps its rows, a failed notification is matched again)
+SEEN_POSTS_BUSY_TIMEOUT = 10
+SEEN_POSTS_WAL_LIMIT = 4 * 1024 * 1024  # Bytes the WAL file is truncated to once it is reset
+# A Bloom filter of seen ids and links answers most "not seen yet" lookups
+# without the database. Expired posts are deleted, the database file shrunk
+# and the filter rebuilt by a background compaction every SEEN_COMPACT_INTERVAL
+SEEN_FILTER_FILE = "seen_posts.bloom"
+SEEN_FILTER_CAPACITY = 200_000  # Keys (ids and links) before the false positive rate rises
+SEEN_FILTER_ERROR_RATE = 0.001
+SEEN_COMPACT_INTERVAL = 6 * 3600
+# Compaction frees pages this many at a time, pausing in between so the bot's
+# own writes never wait long for the lock
+SEEN_COMPACT_VACUUM_PAGES = 500
+SEEN_COMPACT_VACUUM_PAUSE = 0.05
+
+# Repost detection: a listing whose title, price bucket and location hash to
+# within REPOST_MAX_DISTANCE bits of one the same seller had notified in the
+# last REPOST_WINDOW_DAYS is taken for a deleted and reposted listing and not
+# notified again. Listings without a known seller are never suppressed
+REPOST_WINDOW_DAYS = 14
+REPOST_MAX_DISTANCE = 3
+REPOST_PRICE_BUCKET = 100  # zł
+
+# Worker mode: several processes (started with --worker <id>) split the
+# feeds by taking time-bounded leases in SEEN_POSTS_DB and dedup through it.
+# A lease that is not renewed within LEASE_TTL passes to another worker.
+# The command bot takes part as worker WORKER_ID, so it never scrapes a feed
+# another worker holds and its undelivered notifications are not taken over
+WORKER_ID = "main"
+LEASE_TTL = 600
+
+# Pagination: walk result pages until the newest posts of the previous cycle
+# (the watermark) are reached, but never further than MAX_PAGES
+MAX_PAGES = 5
+WATERMARK_SIZE = 10
+# Cycles whose first result page starts with the same card ids as last time
+# stop right there; over HTTP the rest of the page is not even downloaded
+FINGERPRINT_CARDS = 5
+
+# Search feeds, each with its own URL, parser profile and priority. Put a list
+# like DEFAULT_FEEDS into FEEDS_FILE to watch other categories or cities.
+FEEDS_FILE = "feeds.json"
+DEFAULT_FEEDS = [{"name": "iphone", "url": BASE_URL, "parser": "olx", "priority": 2}]
+# How a feed's pages are fetched and how many of them may be walked
+PARSER_PROFILES = {
+    "olx": {"backend": FETCH_BACKEND, "max_pages": MAX_PAGES},
+    "olx_browser": {"backend": "selenium", "max_pages": MAX_PAGES},
+}
+# A feed's adaptive polling interval is multiplied by its priority's factor
+PRIORITY_INTERVAL_FACTORS = {1: 0.5, 2: 1, 3: 2}
+# Budget shared by all feeds and detail pages: requests at once and requests per minute
+FEED_CONCURRENCY = 2
+REQUESTS_PER_MINUTE = 30
+
+STATUS_FILE = "bot_status.json"  # Of the command bot; each --worker keeps bot_status.<id>.json
+SUBSCRIPTIONS_FILE = "subscriptions.json"  # Models of every chat other than CHAT_ID
+# Chats that may /subscribe to alerts of their own. Everyone else's commands
+# manage the models of CHAT_ID, which can be a channel that can't send commands
+SUBSCRIBER_CHAT_IDS = []
+
+# Seconds to collect state changes before writing them to disk
+STATE_WRITE_DELAY = 2
 
 # Default status
 DEFAULT_STATUS = {
@@ -39,6 +296,7 @@ DEFAULT_STATUS = {
     "last_check": None,
     "check_interval": 120,  # 2 minutes in seconds
     "total_posts_found": 0,
+    "skipped_cycles": 0,
     "models_tracked": []
 }
 
@@ -56,215 +314,2681 @@ class JSONHandler:
             logger.error(f"Error loading {file_path}: {e}")
             return default_value if default_value is not None else {}
 
-    @staticmethod
-    def save(file_path, data):
-        """Save data to a JSON file."""
-        try:
-            with open(file_path, 'w', encoding='utf-8') as file:
-                json.dump(data, file, ensure_ascii=False, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"Error saving {file_path}: {e}")
-            return False
+    @staticmethod
+    def save(file_path, data):
+        """Save data to a JSON file atomically (temp file, fsync, rename)."""
+        directory = os.path.dirname(os.path.abspath(file_path))
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(data, file, ensure_ascii=False, indent=2)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, file_path)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {file_path}: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+
+class StateStore:
+    """Models and status kept in memory, written behind to disk in debounced batches."""
+
+    def __init__(self, models_file=MODELS_FILE, status_file=STATUS_FILE, write_delay=STATE_WRITE_DELAY,
+                 subscriptions_file=SUBSCRIPTIONS_FILE, feeds_file=FEEDS_FILE):
+        self.files = {
+            "models": models_file, "status": status_file, "subscriptions": subscriptions_file, "feeds": feeds_file
+        }
+        self.defaults = {"models": [], "status": DEFAULT_STATUS, "subscriptions": {}, "feeds": DEFAULT_FEEDS}
+        self.write_delay = write_delay
+        self.data = {}
+        self.mtimes = {}
+        self.dirty = set()
+        self.flush_task = None
+
+    def mtime(self, name):
+        try:
+            return os.stat(self.files[name]).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, name):
+        """Return the in-memory value, re-reading the file only if it changed on disk."""
+        if name not in self.dirty:
+            mtime = self.mtime(name)
+            if name not in self.data or mtime != self.mtimes.get(name):
+                # Copy the default so callers can't mutate it
+                default = json.loads(json.dumps(self.defaults[name]))
+                self.data[name] = JSONHandler.load(self.files[name], default)
+                self.mtimes[name] = mtime
+        return self.data[name]
+
+    def set(self, name, value):
+        """Replace a value in memory and schedule it to be written to disk."""
+        self.data[name] = value
+        self.dirty.add(name)
+        self.schedule_flush()
+        return True
+
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. during startup): write right away
+            self.flush()
+            return
+        
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = loop.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.write_delay)
+        self.flush()
+
+    def flush(self):
+        """Write every changed value to disk."""
+        if not self.dirty:
+            return
+        
+        with metrics.timer("persistence"):
+            for name in list(self.dirty):
+                if JSONHandler.save(self.files[name], self.data[name]):
+                    self.dirty.discard(name)
+                    self.mtimes[name] = self.mtime(name)
+
+
+class Metrics:
+    """Rolling per-stage timings, error counts and counters for the scrape cycle."""
+    STAGES = ["cycle", "driver_init", "page_load", "card_wait", "extraction", "first_alert",
+              "matching", "dedup", "enrichment", "telegram_send", "persistence"]
+
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.samples = samples
+        self.timings = {}
+        self.totals = {}
+        self.errors = {}
+        self.counters = {}
+        # Browser and compaction threads record too, and the metrics server reads from its own thread
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        """Record one duration for a stage."""
+        with self.lock:
+            self.timings.setdefault(stage, deque(maxlen=self.samples)).append(seconds)
+            count, total = self.totals.get(stage, (0, 0.0))
+            self.totals[stage] = (count + 1, total + seconds)
+
+    def error(self, stage):
+        with self.lock:
+            self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """Return consistent copies of (timings, totals, errors, counters)."""
+        with self.lock:
+            timings = {stage: list(samples) for stage, samples in self.timings.items()}
+            return timings, dict(self.totals), dict(self.errors), dict(self.counters)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Time a block as one observation of the stage, counting exceptions as errors."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.error(stage)
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    @staticmethod
+    def percentile(ordered, fraction):
+        return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+    def summary(self):
+        """Return {stage: {count, errors, p50, p95, max}} with times in milliseconds."""
+        timings, totals, errors, _ = self.snapshot()
+        stages = [stage for stage in self.STAGES if stage in timings or stage in errors]
+        stages += sorted(set(timings) - set(self.STAGES))
+        result = {}
+        for stage in stages:
+            ordered = sorted(timings.get(stage, []))
+            result[stage] = {
+                "count": totals.get(stage, (0, 0.0))[0],
+                "errors": errors.get(stage, 0),
+                "p50": self.percentile(ordered, 0.5) * 1000 if ordered else None,
+                "p95": self.percentile(ordered, 0.95) * 1000 if ordered else None,
+                "max": ordered[-1] * 1000 if ordered else None
+            }
+        return result
+
+    def prometheus_text(self):
+        """Render the metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP olx_stage_seconds Duration of scrape cycle stages.",
+            "# TYPE olx_stage_seconds summary"
+        ]
+        timings, totals, errors, counters = self.snapshot()
+        for stage, samples in timings.items():
+            ordered = sorted(samples)
+            count, total = totals[stage]
+            for quantile in (0.5, 0.95):
+                lines.append(f'olx_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f'{self.percentile(ordered, quantile):.6f}')
+            lines.append(f'olx_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+            lines.append(f'olx_stage_seconds_count{{stage="{stage}"}} {count}')
+        
+        lines += ["# HELP olx_stage_errors_total Errors per scrape cycle stage.",
+                  "# TYPE olx_stage_errors_total counter"]
+        for stage, count in errors.items():
+            lines.append(f'olx_stage_errors_total{{stage="{stage}"}} {count}')
+        
+        for name, value in counters.items():
+            lines += [f"# TYPE olx_{name}_total counter", f"olx_{name}_total {value}"]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """Serve prometheus_text() on localhost from a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        print(f"📈 Metrics served at http://127.0.0.1:{port}/metrics")
+        return server
+
+
+# Global metrics registry shared by all components
+metrics = Metrics()
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter of strings: no false negatives, `error_rate` false positives at capacity."""
+    # Magic, hash count, bit count, keys added, highest seen_posts rowid covered
+    HEADER = struct.Struct("<4sIQQq")
+    MAGIC = b"BLM1"
+
+    def __init__(self, capacity=SEEN_FILTER_CAPACITY, error_rate=SEEN_FILTER_ERROR_RATE, size=None, hashes=None):
+        self.size = size or max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = hashes or max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        # Most lookups are misses and stop at the first clear bit
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        position = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        bits, size = self.bits, self.size
+        for _ in range(self.hashes):
+            index = position % size
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+            position += step
+        return True
+
+    def fill_ratio(self):
+        return bin(int.from_bytes(self.bits, "little")).count("1") / self.size
+
+    def save(self, file_path, rowid):
+        """Write the filter atomically, with the last seen_posts rowid it covers."""
+        tmp_path = f"{file_path}.tmp"
+        try:
+            with open(tmp_path, "wb") as file:
+                file.write(self.HEADER.pack(self.MAGIC, self.hashes, self.size, self.count, rowid))
+                file.write(self.bits)
+            os.replace(tmp_path, file_path)
+        except OSError as e:
+            logger.error(f"Error saving {file_path}: {e}")
+
+    @classmethod
+    def load(cls, file_path):
+        """Return (filter, rowid) from a saved filter, or (None, 0) if it is missing or damaged."""
+        try:
+            with open(file_path, "rb") as file:
+                magic, hashes, size, count, rowid = cls.HEADER.unpack(file.read(cls.HEADER.size))
+                bits = file.read()
+        except (OSError, struct.error):
+            return None, 0
+        if magic != cls.MAGIC or len(bits) != (size + 7) // 8:
+            return None, 0
+        bloom = cls(size=size, hashes=hashes)
+        bloom.bits, bloom.count = bytearray(bits), count
+        return bloom, rowid
+
+
+class SeenPostsStore:
+    """SQLite-backed set of notified posts with lookups by post id and link.
+    
+    A Bloom filter of every seen id and link sits in front of the database:
+    a miss there means "not seen", and only hits are confirmed with a query.
+    """
+
+    def __init__(self, db_path=SEEN_POSTS_DB, ttl_days=SEEN_POSTS_TTL_DAYS, filter_path=None):
+        self.db_path = db_path
+        self.ttl_days = ttl_days
+        self.filter_path = filter_path
+        self.pending = {}
+        self.pending_links = set()
+        self.undelivered = []
+        self.last_compaction = None
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=SEEN_POSTS_BUSY_TIMEOUT)
+        # Only applies to a new database when set before the journal mode
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute(f"PRAGMA journal_mode={SEEN_POSTS_JOURNAL_MODE}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA journal_size_limit={SEEN_POSTS_WAL_LIMIT}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_posts ("
+            "post_id TEXT PRIMARY KEY, link TEXT, title TEXT, model TEXT, "
+            "price TEXT, found_at TEXT, found_ts REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_posts_link ON seen_posts (link)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_posts_found_ts ON seen_posts (found_ts)")
+        # Notifications waiting for delivery; a post moves to seen_posts once it is sent
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "post_id TEXT PRIMARY KEY, link TEXT, chat_id TEXT, message TEXT, "
+            "record TEXT, created_ts REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_link ON outbox (link)")
+        # Worker that owns the delivery of an outbox entry
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")]
+        if "worker" not in columns:
+            self.conn.execute("ALTER TABLE outbox ADD COLUMN worker TEXT")
+        self.conn.commit()
+        # An existing database only switches to incremental vacuum with a full VACUUM,
+        # done once here so compaction never has to lock the database for long
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            print("🧹 Switching the seen posts database to incremental vacuum")
+            try:
+                self.conn.execute("VACUUM")
+            except sqlite3.Error as e:
+                logger.error(f"Error vacuuming seen posts, retrying on the next start: {e}")
+        self.load_filter()
+
+    def load_filter(self):
+        """Load the saved filter and catch up on newer rows, or build it from the database."""
+        bloom, rowid = BloomFilter.load(self.filter_path) if self.filter_path else (None, 0)
+        max_rowid = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM seen_posts").fetchone()[0]
+        # A filter newer than the database belongs to another (replaced) database
+        if bloom is None or rowid > max_rowid:
+            bloom, rowid = self.build_filter(self.conn)
+        self.install_filter(bloom, rowid)
+
+    @staticmethod
+    def build_filter(conn):
+        """Build a filter of every seen id and link, returning it with the last rowid it covers."""
+        count, rowid = conn.execute("SELECT COUNT(*), COALESCE(MAX(rowid), 0) FROM seen_posts").fetchone()
+        bloom = BloomFilter(max(SEEN_FILTER_CAPACITY, 4 * count))
+        for post_id, link in conn.execute("SELECT post_id, link FROM seen_posts WHERE rowid <= ?", (rowid,)):
+            bloom.add(post_id)
+            if link:
+                bloom.add(link)
+        return bloom, rowid
+
+    def install_filter(self, bloom, rowid):
+        """Start using a filter, adding what was seen or queued after it was built."""
+        self.filter, self.filter_rowid = bloom, rowid
+        self.sync()
+        for post_id, link in self.conn.execute("SELECT post_id, link FROM outbox"):
+            self.filter.add(post_id)
+            if link:
+                self.filter.add(link)
+        for post_id, record in self.pending.items():
+            self.filter.add(post_id)
+            if record.get("link"):
+                self.filter.add(record["link"])
+
+    def sync(self):
+        """Add posts that other workers marked as seen since the last sync to the filter."""
+        rows = self.conn.execute(
+            "SELECT rowid, post_id, link FROM seen_posts WHERE rowid > ? ORDER BY rowid", (self.filter_rowid,)
+        ).fetchall()
+        for rowid, post_id, link in rows:
+            self.filter.add(post_id)
+            if link:
+                self.filter.add(link)
+            self.filter_rowid = rowid
+
+    def __contains__(self, post_id):
+        if post_id in self.pending:
+            return True
+        if post_id not in self.filter:
+            return False
+        row = self.conn.execute(
+            "SELECT 1 FROM seen_posts WHERE post_id = ? UNION ALL SELECT 1 FROM outbox WHERE post_id = ?",
+            (post_id, post_id)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM seen_posts").fetchone()[0]
+        return count + len(self.pending)
+
+    def has_link(self, link):
+        """Check whether a post with this link was already notified."""
+        if link in self.pending_links:
+            return True
+        if link not in self.filter:
+            return False
+        row = self.conn.execute(
+            "SELECT 1 FROM seen_posts WHERE link = ? UNION ALL SELECT 1 FROM outbox WHERE link = ?",
+            (link, link)
+        ).fetchone()
+        return row is not None
+
+    @staticmethod
+    def key(value, chat_id=None):
+        """Seen-state key of a post id or link for one chat; the main chat keeps plain keys."""
+        if chat_id is None or str(chat_id) == str(CHAT_ID):
+            return value
+        return f"{chat_id}:{value}"
+
+    def enqueue_notification(self, post_id, chat_id, message, record, link=None, worker=None):
+        """Persist a notification before it is sent, so it survives a crash or restart.
+        
+        Returns False when the post is already notified or queued, possibly by another
+        worker: the check and the insert are one statement, so only one of them wins.
+        """
+        link = link or record.get("link")
+        with metrics.timer("persistence"), self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO outbox (post_id, link, chat_id, message, record, created_ts, worker) "
+                "SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS ("
+                "SELECT 1 FROM seen_posts WHERE post_id = ? OR link = ? "
+                "UNION ALL SELECT 1 FROM outbox WHERE link = ?)",
+                (post_id, link, str(chat_id), message, json.dumps(record, ensure_ascii=False), time.time(),
+                 worker, post_id, link, link)
+            )
+        if cursor.rowcount != 1:
+            return False
+        self.filter.add(post_id)
+        if link:
+            self.filter.add(link)
+        return True
+
+    @staticmethod
+    def outbox_items(rows):
+        return [
+            {"post_id": post_id, "chat_id": chat_id, "message": message, "record": json.loads(record)}
+            for post_id, chat_id, message, record in rows
+        ]
+
+    def pending_notifications(self, worker=None, unowned=False):
+        """Return the undelivered notifications (of one worker), oldest first.
+        
+        With `unowned` the worker also gets entries queued without a worker id,
+        before worker ids were recorded.
+        """
+        if worker is None:
+            rows = self.conn.execute(
+                "SELECT post_id, chat_id, message, record FROM outbox ORDER BY created_ts"
+            ).fetchall()
+        else:
+            rows = self.conn.execute(
+                "SELECT post_id, chat_id, message, record FROM outbox "
+                "WHERE worker = ? OR (? AND worker IS NULL) ORDER BY created_ts",
+                (worker, unowned)
+            ).fetchall()
+        return self.outbox_items(rows)
+
+    def claim_orphans(self, worker, alive_workers):
+        """Take over undelivered notifications whose worker is gone and return them."""
+        alive = sorted(set(alive_workers) | {worker})
+        placeholders = ", ".join("?" * len(alive))
+        try:
+            with self.conn:
+                # Locks the database, so two workers can't claim the same entries
+                self.conn.execute("BEGIN IMMEDIATE")
+                rows = self.conn.execute(
+                    "SELECT post_id, chat_id, message, record FROM outbox "
+                    f"WHERE worker IS NOT NULL AND worker NOT IN ({placeholders}) ORDER BY created_ts",
+                    alive
+                ).fetchall()
+                self.conn.executemany(
+                    "UPDATE outbox SET worker = ? WHERE post_id = ?", [(worker, row[0]) for row in rows]
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error claiming orphaned notifications: {e}")
+            return []
+        return self.outbox_items(rows)
+
+    def mark_delivered(self, post_ids):
+        """Move delivered notifications from the outbox into the seen posts.
+        
+        Notifications that can't be moved (the database is locked) stay in the
+        outbox, still deduplicated, and are moved on the next call or flush().
+        """
+        post_ids = self.undelivered + list(post_ids)
+        try:
+            rows = []
+            for post_id in post_ids:
+                row = self.conn.execute("SELECT link, record FROM outbox WHERE post_id = ?", (post_id,)).fetchone()
+                if row:
+                    rows.append((post_id, row[0], json.loads(row[1])))
+            
+            with metrics.timer("persistence"), self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO seen_posts "
+                    "(post_id, link, title, model, price, found_at, found_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(post_id, link, record.get("title"), record.get("model"),
+                      record.get("price"), record.get("found_at"), time.time()) for post_id, link, record in rows]
+                )
+                self.conn.executemany("DELETE FROM outbox WHERE post_id = ?", [(post_id,) for post_id, _, _ in rows])
+            self.undelivered = []
+        except sqlite3.Error as e:
+            logger.error(f"Error marking notifications as delivered: {e}")
+            self.undelivered = post_ids
+
+    def add(self, post_id, record):
+        """Queue a post as seen; it is written to disk on the next flush()."""
+        self.pending[post_id] = record
+        self.pending_links.add(record.get("link"))
+        self.filter.add(post_id)
+        if record.get("link"):
+            self.filter.add(record["link"])
+
+    def flush(self):
+        """Write all queued posts in a single transaction."""
+        if self.undelivered:
+            self.mark_delivered([])
+        if not self.pending:
+            return
+        
+        rows = []
+        for post_id, record in self.pending.items():
+            found_at = record.get("found_at")
+            try:
+                found_ts = datetime.strptime(found_at, "%Y-%m-%d %H:%M:%S").timestamp()
+            except (TypeError, ValueError):
+                found_ts = time.time()
+            rows.append((post_id, record.get("link"), record.get("title"), record.get("model"),
+                         record.get("price"), found_at, found_ts))
+        
+        try:
+            with metrics.timer("persistence"), self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO seen_posts "
+                    "(post_id, link, title, model, price, found_at, found_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            self.pending.clear()
+            self.pending_links.clear()
+        except sqlite3.Error as e:
+            logger.error(f"Error saving seen posts: {e}")
+
+    def evict(self, conn=None):
+        """Remove posts older than the configured TTL."""
+        if not self.ttl_days:
+            return 0
+        
+        conn = conn or self.conn
+        cutoff = time.time() - self.ttl_days * 86400
+        try:
+            with conn:
+                deleted = conn.execute("DELETE FROM seen_posts WHERE found_ts < ?", (cutoff,)).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"Error evicting seen posts: {e}")
+            return 0
+        if deleted:
+            print(f"Evicted {deleted} seen posts older than {self.ttl_days} days")
+        return deleted
+
+    def compact(self):
+        """Expire old posts, shrink the database and build a fresh filter.
+        
+        Runs in a worker thread on its own connection; pass the result to
+        install_filter() from the event loop.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute(f"PRAGMA journal_size_limit={SEEN_POSTS_WAL_LIMIT}")
+            deleted = self.evict(conn)
+            # Hand the pages of expired posts back to the filesystem in short transactions
+            # instead of a VACUUM, which would lock out every other writer until it's done
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                while free_pages:
+                    # executescript steps the pragma until the whole batch is freed
+                    conn.executescript(f"PRAGMA incremental_vacuum({SEEN_COMPACT_VACUUM_PAGES})")
+                    remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                    if remaining >= free_pages:
+                        break
+                    free_pages = remaining
+                    time.sleep(SEEN_COMPACT_VACUUM_PAUSE)
+            # Unlike TRUNCATE, a passive checkpoint never blocks writers
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            bloom, rowid = self.build_filter(conn)
+        except sqlite3.Error as e:
+            logger.error(f"Error compacting seen posts: {e}")
+            return None, 0, 0
+        finally:
+            conn.close()
+        return bloom, rowid, deleted
+
+    def save_filter(self):
+        if self.filter_path:
+            self.filter.save(self.filter_path, self.filter_rowid)
+
+    def memory_report(self):
+        """Sizes of the seen-state in memory and on disk."""
+        disk = sum(os.path.getsize(self.db_path + suffix)
+                   for suffix in ("", "-wal") if os.path.exists(self.db_path + suffix))
+        fill = self.filter.fill_ratio()
+        return {
+            "seen_posts": len(self),
+            "outbox": self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0],
+            "filter_keys": self.filter.count,
+            "filter_kb": len(self.filter.bits) / 1024,
+            "filter_fill": fill,
+            "filter_error_rate": fill ** self.filter.hashes,
+            "database_kb": disk / 1024,
+            "last_compaction": self.last_compaction
+        }
+
+    def migrate_json(self, file_path=SEEN_POSTS_FILE):
+        """Import a legacy seen_posts.json once, then rename it so it is not imported again."""
+        if not os.path.exists(file_path):
+            return 0
+        
+        seen_posts = JSONHandler.load(file_path, {})
+        for post_id, record in seen_posts.items():
+            self.add(post_id, record if isinstance(record, dict) else {})
+        count = len(self.pending)
+        self.flush()
+        
+        if not self.pending:
+            os.replace(file_path, file_path + ".migrated")
+            print(f"Migrated {count} seen posts from {file_path} to the database")
+        return count
+
+    def close(self):
+        """Flush queued posts, save the filter and close the database."""
+        self.flush()
+        self.save_filter()
+        self.conn.close()
+
+
+class RepostDetector:
+    """SimHash fingerprints of notified listings in an LSH index, to catch reposts under a new id."""
+    # Four 16-bit bands: fingerprints within 3 bits share at least one band exactly
+    BANDS = 4
+    BAND_BITS = 16
+    TOKEN = re.compile(r"[a-z0-9ąćęłńóśźż]+")
+
+    def __init__(self, db_path=SEEN_POSTS_DB, window_days=REPOST_WINDOW_DAYS, max_distance=REPOST_MAX_DISTANCE):
+        self.window = window_days * 86400
+        self.max_distance = max_distance
+        self.buckets = [{} for _ in range(self.BANDS)]
+        self.entries = deque()  # (ts, fingerprint, chat_id, post_id, seller), oldest first
+        self.keys = set()
+        self.synced_ts = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # Shares the seen posts database, which may not exist yet (see SeenPostsStore)
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS reposts ("
+            "chat_id TEXT, post_id TEXT, fingerprint INTEGER NOT NULL, found_ts REAL NOT NULL, "
+            "PRIMARY KEY (chat_id, post_id))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_reposts_found_ts ON reposts (found_ts)")
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(reposts)")]
+        if "seller" not in columns:
+            self.conn.execute("ALTER TABLE reposts ADD COLUMN seller TEXT")
+        self.conn.commit()
+        self.sync()
+
+    @staticmethod
+    def seller_of(post):
+        """Seller id from the search results or the detail page, None when unknown."""
+        return post.get("seller") or (post.get("details") or {}).get("seller")
+
+    @classmethod
+    def fingerprint(cls, post):
+        """64-bit SimHash of the title words and word pairs, the price bucket and the location."""
+        words = cls.TOKEN.findall(post.get("title", "").lower())
+        features = {word: 1 for word in words}
+        features.update({f"{a} {b}": 1 for a, b in zip(words, words[1:])})
+        if post.get("price"):
+            features[f"price:{post['price'] // REPOST_PRICE_BUCKET}"] = 3
+        features[f"location:{RuleEngine.location_of(post).lower()}"] = 3
+        
+        # A bit is set when the features hashing a 1 there outweigh the others
+        counts, total = [0] * 64, 0
+        for feature, weight in features.items():
+            bits = f"{int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'big'):064b}"
+            counts = [count + weight if bit == "1" else count for count, bit in zip(counts, bits)]
+            total += weight
+        return int("".join("1" if 2 * count > total else "0" for count in counts), 2)
+
+    def bands(self, fingerprint):
+        mask = (1 << self.BAND_BITS) - 1
+        return [(fingerprint >> (band * self.BAND_BITS)) & mask for band in range(self.BANDS)]
+
+    def index(self, ts, fingerprint, chat_id, post_id, seller):
+        if (chat_id, post_id) in self.keys:
+            return
+        entry = (ts, fingerprint, chat_id, post_id, seller)
+        self.keys.add((chat_id, post_id))
+        self.entries.append(entry)
+        for band, value in enumerate(self.bands(fingerprint)):
+            self.buckets[band].setdefault(value, []).append(entry)
+
+    def expire(self, now=None):
+        cutoff = (now or time.time()) - self.window
+        while self.entries and self.entries[0][0] < cutoff:
+            entry = self.entries.popleft()
+            self.keys.discard((entry[2], entry[3]))
+            for band, value in enumerate(self.bands(entry[1])):
+                bucket = self.buckets[band][value]
+                bucket.remove(entry)
+                if not bucket:
+                    del self.buckets[band][value]
+
+    def sync(self):
+        """Index fingerprints added since the last sync, also by other workers."""
+        cutoff = max(self.synced_ts, time.time() - self.window)
+        rows = self.conn.execute(
+            "SELECT found_ts, fingerprint, chat_id, post_id, seller FROM reposts WHERE found_ts > ? ORDER BY found_ts",
+            (cutoff,)
+        ).fetchall()
+        for ts, fingerprint, chat_id, post_id, seller in rows:
+            # SQLite integers are signed
+            self.index(ts, fingerprint % (1 << 64), chat_id, post_id, seller)
+            self.synced_ts = max(self.synced_ts, ts)
+        self.expire()
+
+    def find(self, post, chat_id):
+        """Return the id of an earlier listing of the same seller this one is a repost of, or None."""
+        # Two sellers offering the same model in one city at one price are not a repost
+        seller = self.seller_of(post)
+        if not seller:
+            return None
+        fingerprint = self.fingerprint(post)
+        for band, value in enumerate(self.bands(fingerprint)):
+            for ts, other, other_chat, post_id, other_seller in self.buckets[band].get(value, ()):
+                if (other_chat == str(chat_id) and other_seller == seller and post_id != post["id"]
+                        and bin(fingerprint ^ other).count("1") <= self.max_distance):
+                    return post_id
+        return None
+
+    def add(self, post, chat_id):
+        """Remember a notified listing."""
+        now = time.time()
+        fingerprint = self.fingerprint(post)
+        seller = self.seller_of(post)
+        self.index(now, fingerprint, str(chat_id), post["id"], seller)
+        signed = fingerprint - (1 << 64) if fingerprint >= 1 << 63 else fingerprint
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO reposts (chat_id, post_id, fingerprint, found_ts, seller) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (str(chat_id), post["id"], signed, now, seller)
+                )
+                self.conn.execute("DELETE FROM reposts WHERE found_ts < ?", (now - self.window,))
+        except sqlite3.Error as e:
+            logger.error(f"Error saving repost fingerprint: {e}")
+
+    def close(self):
+        self.conn.close()
+
+
+class LeaseStore:
+    """Time-bounded leases on search shards, shared by all workers through SQLite."""
+
+    def __init__(self, db_path=SEEN_POSTS_DB, worker_id=WORKER_ID, ttl=LEASE_TTL):
+        self.worker_id = str(worker_id)
+        self.ttl = ttl
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # Shares the seen posts database, which may not exist yet (see SeenPostsStore)
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute(f"PRAGMA journal_mode={SEEN_POSTS_JOURNAL_MODE}")
+        # A "worker:<id>" row is that worker's heartbeat; "state" keeps a shard's
+        # watermark, so whoever takes the lease over continues where it stopped
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            "shard TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_ts REAL NOT NULL, state TEXT)"
+        )
+        self.conn.commit()
+
+    def acquire(self, shard):
+        """Take or renew the lease on a shard; False while another worker holds it."""
+        now = time.time()
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO leases (shard, owner, expires_ts) VALUES (?, ?, ?) "
+                    "ON CONFLICT (shard) DO UPDATE SET owner = excluded.owner, expires_ts = excluded.expires_ts "
+                    "WHERE leases.owner = excluded.owner OR leases.expires_ts < ?",
+                    (shard, self.worker_id, now + self.ttl, now)
+                )
+                row = self.conn.execute("SELECT owner FROM leases WHERE shard = ?", (shard,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Error acquiring lease on {shard}: {e}")
+            return False
+        return row is not None and row[0] == self.worker_id
+
+    def release(self, shard):
+        """Give up a lease so another worker can take it right away."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE leases SET expires_ts = 0 WHERE shard = ? AND owner = ?", (shard, self.worker_id)
+            )
+
+    def heartbeat(self):
+        return self.acquire(f"worker:{self.worker_id}")
+
+    def renew(self):
+        """Extend the heartbeat and every lease still held; returns the shards held."""
+        self.heartbeat()
+        return {shard for shard in self.held() if self.acquire(shard)}
+
+    def alive_workers(self):
+        rows = self.conn.execute(
+            "SELECT owner FROM leases WHERE shard LIKE 'worker:%' AND expires_ts >= ?", (time.time(),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def held(self):
+        rows = self.conn.execute(
+            "SELECT shard FROM leases WHERE owner = ? AND expires_ts >= ? AND shard NOT LIKE 'worker:%'",
+            (self.worker_id, time.time())
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    def balance(self, shards):
+        """Hold a fair share of the shards and return them; extra leases are released."""
+        self.heartbeat()
+        share = -(-len(shards) // max(1, len(self.alive_workers())))
+        held = [shard for shard in shards if shard in self.held()]
+        
+        # Another worker joined: hand over what is above our share
+        for shard in held[share:]:
+            self.release(shard)
+        held = [shard for shard in held[:share] if self.acquire(shard)]
+        
+        free = [shard for shard in shards if shard not in held]
+        random.shuffle(free)
+        for shard in free:
+            if len(held) >= share:
+                break
+            if self.acquire(shard):
+                print(f"🔑 Worker {self.worker_id} took the lease on {shard}")
+                held.append(shard)
+        return held
+
+    def load_state(self, shard):
+        row = self.conn.execute("SELECT state FROM leases WHERE shard = ?", (shard,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def save_state(self, shard, state):
+        """Store a shard's state, unless the lease was lost in the meantime."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE leases SET state = ? WHERE shard = ? AND owner = ?",
+                (json.dumps(state, ensure_ascii=False), shard, self.worker_id)
+            )
+
+    def release_all(self):
+        """Drop every lease and the heartbeat when the worker shuts down."""
+        with self.conn:
+            self.conn.execute("UPDATE leases SET expires_ts = 0 WHERE owner = ?", (self.worker_id,))
+
+    def close(self):
+        self.conn.close()
+
+
+class TokenBucket:
+    """Async token bucket allowing `rate` operations per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class NotificationDispatcher:
+    """Deliver match notifications from a background queue with rate limiting and retries."""
+
+    def __init__(self, bot, store, chat_id=CHAT_ID, digest_window=DIGEST_WINDOW, worker_id=None):
+        self.bot = bot
+        self.store = store
+        self.chat_id = chat_id
+        self.worker_id = worker_id
+        self.digest_window = digest_window
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(GLOBAL_MESSAGES_PER_SECOND)
+        self.chat_buckets = {}
+        self.task = None
+        self.requeue_tasks = set()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        """Start the worker and re-queue notifications left over from a previous run."""
+        if self.task and not self.task.done():
+            return
+        
+        import_telegram()
+        # Entries without a worker id predate worker mode and belong to the command bot
+        for item in self.store.pending_notifications(self.worker_id, unowned=self.worker_id == WORKER_ID):
+            self.queue.put_nowait(item)
+        if not self.queue.empty():
+            print(f"📬 Resending {self.queue.qsize()} undelivered notifications")
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=5):
+        """Give queued notifications a moment to go out, then stop the worker."""
+        if not self.task:
+            return
+        
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️ {self.queue.qsize()} notifications left in the outbox")
+        
+        self.task.cancel()
+        for task in self.requeue_tasks:
+            task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.requeue_tasks.clear()
+        # Whatever is still queued stays in the outbox and is resent by start()
+        self.queue = asyncio.Queue()
+
+    async def submit(self, post_id, message, record, chat_id=None):
+        """Store a notification in the outbox and queue it for delivery, once across all workers."""
+        chat_id = str(chat_id or self.chat_id)
+        key = SeenPostsStore.key(post_id, chat_id)
+        link = SeenPostsStore.key(record["link"], chat_id)
+        if not self.store.enqueue_notification(key, chat_id, message, record, link=link, worker=self.worker_id):
+            return False
+        await self.queue.put({"post_id": key, "chat_id": chat_id, "message": message, "record": record})
+        return True
+
+    async def adopt_orphans(self, alive_workers):
+        """Queue notifications left undelivered by workers that died."""
+        items = self.store.claim_orphans(self.worker_id, alive_workers)
+        if items:
+            print(f"📬 Taking over {len(items)} undelivered notifications")
+        for item in items:
+            await self.queue.put(item)
+
+    async def run(self):
+        """Worker loop: take notifications off the queue and deliver them."""
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                # Collect a burst of matches into one digest
+                if self.digest_window:
+                    deadline = time.monotonic() + self.digest_window
+                    while len(batch) < DIGEST_MAX_ITEMS:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        try:
+                            batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+                        except asyncio.TimeoutError:
+                            break
+                
+                for chat_id, items in self.group_by_chat(batch).items():
+                    await self.deliver(chat_id, items)
+            except Exception as e:
+                logger.error(f"Error in notification worker: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    @staticmethod
+    def group_by_chat(batch):
+        groups = {}
+        for item in batch:
+            groups.setdefault(item["chat_id"], []).append(item)
+        return groups
+
+    @staticmethod
+    def build_digest(items):
+        """Combine several notifications into one message."""
+        message = f"🔔 <b>{len(items)} New iPhone Listings</b> 🔔\n"
+        for i, item in enumerate(items, 1):
+            record = item["record"]
+            message += (
+                f"\n{i}. 📱 <b>{escape(str(record.get('model')))}</b> - {escape(str(record.get('price')))}\n"
+                f"🔗 <a href=\"{escape(str(record.get('link')))}\">{escape(str(record.get('title')))}</a>\n"
+            )
+        return message
+
+    def requeue(self, items):
+        """Queue notifications again later, each time after a longer delay."""
+        requeues = max(item.get("requeues", 0) for item in items)
+        delay = min(NOTIFICATION_REQUEUE_DELAY * 2 ** requeues, NOTIFICATION_REQUEUE_MAX_DELAY)
+        print(f"🔁 Retrying {len(items)} notifications in {delay} seconds")
+        
+        async def put_back():
+            await asyncio.sleep(delay)
+            for item in items:
+                await self.queue.put(dict(item, requeues=requeues + 1))
+        
+        task = asyncio.create_task(put_back())
+        self.requeue_tasks.add(task)
+        task.add_done_callback(self.requeue_tasks.discard)
+
+    async def deliver(self, chat_id, items):
+        """Send one message (or a digest) with rate limiting and retries."""
+        text = items[0]["message"] if len(items) == 1 else self.build_digest(items)
+        post_ids = [item["post_id"] for item in items]
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(CHAT_MESSAGES_PER_SECOND))
+        delay = NOTIFICATION_BACKOFF
+        
+        for attempt in range(1, NOTIFICATION_MAX_RETRIES + 1):
+            await self.global_bucket.acquire()
+            await bucket.acquire()
+            try:
+                with metrics.timer("telegram_send"):
+                    await self.bot.send_message(
+                        chat_id=chat_id,
+                        text=text,
+                        parse_mode='HTML',
+                        disable_web_page_preview=len(items) > 1
+                    )
+                self.store.mark_delivered(post_ids)
+                self.sent += len(items)
+                metrics.increment("notifications_sent", len(items))
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                wait = retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else retry_after
+                print(f"⏳ Telegram flood control, retrying in {wait} seconds")
+                await asyncio.sleep(wait)
+            except BadRequest as e:
+                # The message itself is rejected; retrying can't help, so don't resend it forever
+                logger.error(f"Telegram rejected notification for {post_ids}: {e}")
+                self.store.mark_delivered(post_ids)
+                self.failed += len(items)
+                metrics.increment("notifications_failed", len(items))
+                return False
+            except Exception as e:
+                logger.error(f"Error sending notification (attempt {attempt}/{NOTIFICATION_MAX_RETRIES}): {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+        
+        # Still in the outbox, which also keeps the post from being queued twice meanwhile
+        self.failed += len(items)
+        metrics.increment("notifications_failed", len(items))
+        self.requeue(items)
+        return False
+
+
+class PollScheduler:
+    """Choose the wait between scrape cycles from the listing rate per hour of day and failures."""
+
+    def __init__(self, base_interval=DEFAULT_STATUS["check_interval"]):
+        self.base_interval = base_interval
+        self.hourly_rate = [None] * 24  # Smoothed new listings per second for each hour
+        self.failures = 0
+        self.last_cycle = None
+        self.wake_event = asyncio.Event()
+
+    def record_cycle(self, success, new_posts):
+        """Update the failure count and the listing rate for the current hour."""
+        now = time.monotonic()
+        if not success:
+            self.failures += 1
+            return
+        
+        self.failures = 0
+        if self.last_cycle is None:
+            self.last_cycle = now
+            return
+        # A cycle without new posts (or a skipped one) is no sample of its own: the
+        # window grows until listings show up and their rate is taken over all of it
+        if not new_posts or now <= self.last_cycle:
+            return
+        rate = new_posts / (now - self.last_cycle)
+        hour = datetime.now().hour
+        previous = self.hourly_rate[hour]
+        self.hourly_rate[hour] = rate if previous is None else (
+            RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * previous
+        )
+        self.last_cycle = now
+
+    def next_interval(self):
+        """Seconds to wait before the next cycle."""
+        if self.failures:
+            # Exponential backoff after consecutive failures
+            interval = self.base_interval * 2 ** self.failures
+        else:
+            rate = self.hourly_rate[datetime.now().hour]
+            # The floor keeps a quiet stretch from pushing the wait past the maximum
+            interval = self.base_interval if rate is None else TARGET_NEW_POSTS / max(
+                rate, TARGET_NEW_POSTS / MAX_CHECK_INTERVAL
+            )
+        
+        # Jitter first, so the bounds hold for the actual wait
+        interval *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        return max(MIN_CHECK_INTERVAL, min(MAX_CHECK_INTERVAL, interval))
+
+    def wake(self):
+        """End the current wait early (stop request or config change)."""
+        self.wake_event.set()
+
+    async def wait(self, interval):
+        """Sleep for the interval or until woken; returns True if woken early."""
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), timeout=interval)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.wake_event.clear()
+
+
+class CardHTMLParser(HTMLParser):
+    """Collect listing cards from OLX search page HTML without a browser."""
+    VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "source", "track", "wbr"}
+    FIELD_TAGS = {
+        ("h4", None): "title",
+        ("h6", None): "title",
+        ("p", "ad-price"): "price_text",
+        ("p", "location-date"): "location_time"
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.cards = []
+        self.card = None
+        self.depth = 0
+        self.field = None
+        self.field_depth = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.card is None:
+            if attrs.get("data-cy") == "l-card" and tag not in self.VOID_TAGS:
+                self.card = {"card_id": attrs.get("id"), "promoted": False}
+                self.depth = 1
+            return
+        
+        if attrs.get("data-testid") == "adCard-featured":
+            self.card["promoted"] = True
+        
+        if tag in self.VOID_TAGS:
+            return
+        self.depth += 1
+        
+        if tag == "a" and "link" not in self.card and attrs.get("href"):
+            self.card["link"] = attrs["href"]
+        
+        field = self.FIELD_TAGS.get((tag, attrs.get("data-testid")))
+        if self.field is None and field and field not in self.card:
+            self.field = field
+            self.field_depth = self.depth
+            self.text = []
+
+    def handle_endtag(self, tag):
+        if self.card is None or tag in self.VOID_TAGS:
+            return
+        
+        if self.field and self.depth == self.field_depth:
+            self.card[self.field] = " ".join(" ".join(self.text).split())
+            self.field = None
+        
+        self.depth -= 1
+        if self.depth == 0:
+            self.cards.append(self.card)
+            self.card = None
+
+    def handle_data(self, data):
+        if self.field:
+            self.text.append(data)
+
+
+class HTTPFetcher:
+    """Fetch OLX search pages over plain async HTTP with a keep-alive connection pool."""
+    PRERENDERED_STATE = re.compile(r'window\.__PRERENDERED_STATE__\s*=\s*("(?:[^"\\]|\\.)*")\s*;')
+    LISTING_ID = re.compile(r'oferta\\?/[^"\'\s<>]*?-ID([a-zA-Z0-9]+)\.html')
+    CARD_START = re.compile(r'data-cy=\\?["\']l-card\\?["\']')
+    PROMOTED_CARD = re.compile(r'adCard-featured')
+    PROMOTED_AD = re.compile(r'isPromoted\\?"\s*:\s*true')
+
+    def __init__(self, timeout=15):
+        self.timeout = timeout
+        self.client = None
+
+    async def initialize(self):
+        """Create the shared HTTP client."""
+        self.client = httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT, "Accept-Language": "pl-PL,pl;q=0.9"},
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=300)
+        )
+
+    async def close(self):
+        """Close the HTTP client and its pooled connections."""
+        if self.client:
+            try:
+                await self.client.aclose()
+            except Exception as e:
+                logger.error(f"Error closing HTTP client: {e}")
+            self.client = None
+
+    async def fetch_text(self, url):
+        """Download a page and return its HTML."""
+        if not self.client:
+            await self.initialize()
+        
+        response = await self.client.get(url)
+        response.raise_for_status()
+        return response.text
+
+    @classmethod
+    def listing_segments(cls, text):
+        """Split the text into one piece per listing, in page order.
+        
+        Returns (pieces with whether the next listing has started, promotion marker).
+        A listing runs from one card's markup to the next or, when the embedded
+        JSON state comes before the markup, from one ad's url to the next ad's.
+        """
+        first_card, first_id = cls.CARD_START.search(text), cls.LISTING_ID.search(text)
+        if first_card and (not first_id or first_card.start() < first_id.start()):
+            starts = [match.start() for match in cls.CARD_START.finditer(text)]
+            promoted = cls.PROMOTED_CARD
+        else:
+            starts, previous = [], None
+            for match in cls.LISTING_ID.finditer(text):
+                if match.group(1) != previous:
+                    starts.append(match.start())
+                    previous = match.group(1)
+            promoted = cls.PROMOTED_AD
+        pieces = ((text[start:end], end is not None) for start, end in zip(starts, starts[1:] + [None]))
+        return pieces, promoted
+
+    @classmethod
+    def fingerprint(cls, text, complete=True):
+        """Hash of the first FINGERPRINT_CARDS organic listing ids in the text, None if there aren't enough yet.
+        
+        Promoted cards are pinned to the top of the list, so they are left out:
+        otherwise new listings below them would never change the fingerprint.
+        """
+        ids = []
+        pieces, promoted = cls.listing_segments(text)
+        for segment, closed in pieces:
+            # The last listing may still be missing its promotion marker
+            if not (closed or complete):
+                break
+            match = cls.LISTING_ID.search(segment)
+            if not match or match.group(1) in ids or promoted.search(segment):
+                continue
+            ids.append(match.group(1))
+            if len(ids) == FINGERPRINT_CARDS:
+                break
+        if not ids or (len(ids) < FINGERPRINT_CARDS and not complete):
+            return None
+        return hashlib.sha1("|".join(ids).encode()).hexdigest()[:16]
+
+    async def fetch(self, url, previous=None):
+        """Download a search page and return (raw cards, fingerprint).
+        
+        The page is streamed; if its fingerprint equals `previous` the download
+        stops there and the cards are None.
+        """
+        if not self.client:
+            await self.initialize()
+        
+        with metrics.timer("page_load"):
+            async with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+                chunks, fingerprint = [], None
+                async for chunk in response.aiter_text():
+                    chunks.append(chunk)
+                    if previous and fingerprint is None:
+                        fingerprint = self.fingerprint("".join(chunks), complete=False)
+                        if fingerprint == previous:
+                            return None, fingerprint
+                html = "".join(chunks)
+                base_url = str(response.url)
+        with metrics.timer("extraction"):
+            return self.parse(html, base_url), fingerprint or self.fingerprint(html)
+
+    @classmethod
+    def parse(cls, html, base_url):
+        """Parse raw cards from the embedded JSON state, falling back to the card markup."""
+        cards = cls.parse_prerendered_state(html, base_url)
+        if not cards:
+            parser = CardHTMLParser()
+            parser.feed(html)
+            parser.close()
+            cards = parser.cards
+        
+        for card in cards:
+            if card.get("link"):
+                card["link"] = urljoin(base_url, card["link"])
+        return cards
+
+    @classmethod
+    def parse_prerendered_state(cls, html, base_url):
+        """Read listings from the window.__PRERENDERED_STATE__ JSON embedded in the page."""
+        match = cls.PRERENDERED_STATE.search(html)
+        if not match:
+            return []
+        
+        try:
+            state = json.loads(json.loads(match.group(1)))
+            ads = state["listing"]["listing"]["ads"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Error parsing embedded listing state: {e}")
+            return []
+        
+        cards = []
+        for ad in ads:
+            if not isinstance(ad, dict):
+                continue
+            price = ad.get("price") or {}
+            location = ad.get("location") or {}
+            location_parts = [location.get("cityName"), location.get("regionName")]
+            location_text = ", ".join(part for part in location_parts if part)
+            if ad.get("createdTime"):
+                location_text += f" - {ad['createdTime']}"
+            cards.append({
+                "card_id": str(ad.get("id")) if ad.get("id") else None,
+                "link": ad.get("url"),
+                "title": ad.get("title"),
+                "price_text": price.get("displayValue"),
+                "location_time": location_text or None,
+                "promoted": bool(ad.get("isPromoted")),
+                "seller": str((ad.get("user") or {}).get("id") or "") or None
+            })
+        return cards
+
+
+class TTLCache:
+    """Small LRU cache whose entries also expire after `ttl` seconds."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.items[key] = (value, time.monotonic() + self.ttl)
+        self.items.move_to_end(key)
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class DetailHTMLParser(HTMLParser):
+    """Collect the parameter list and description from an OLX ad page."""
+    SECTIONS = {"ad-parameters-container": "parameters", "ad_description": "description"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parameters = []
+        self.description = []
+        self.section = None
+        self.depth = 0
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in CardHTMLParser.VOID_TAGS:
+            return
+        attrs = dict(attrs)
+        if self.section is None:
+            section = self.SECTIONS.get(attrs.get("data-testid")) or self.SECTIONS.get(attrs.get("data-cy"))
+            if section:
+                self.section = section
+                self.depth = 1
+            return
+        self.depth += 1
+
+    def handle_endtag(self, tag):
+        if self.section is None or tag in CardHTMLParser.VOID_TAGS:
+            return
+        
+        # Each parameter is its own element inside the container
+        if self.section == "parameters" and self.text:
+            self.parameters.append(" ".join(" ".join(self.text).split()))
+            self.text = []
+        
+        self.depth -= 1
+        if self.depth == 0:
+            self.section = None
+
+    def handle_data(self, data):
+        if self.section == "parameters" and data.strip():
+            self.text.append(data)
+        elif self.section == "description":
+            self.description.append(data)
+
+
+class DetailEnricher:
+    """Fetch detail pages of candidate matches concurrently and filter out false positives."""
+    STORAGE = re.compile(r"\b(\d{1,4})\s*(gb|tb)\b", re.IGNORECASE)
+    # Whole words only: "nieuszkodzony" and "nie-uszkodzony" don't contain "uszkodzony"
+    DAMAGE = [(keyword, re.compile(rf"(?<![\w-]){re.escape(keyword)}(?![\w-])")) for keyword in DAMAGE_KEYWORDS]
+    ACCESSORY = re.compile(rf"(?<![\w-])({'|'.join(map(re.escape, ACCESSORY_KEYWORDS))})(?![\w-])")
+    EXTRAS_BEFORE = re.compile(rf"(?<![\w-])(?:{'|'.join(map(re.escape, ACCESSORY_EXTRAS_BEFORE))})(?![\w-])")
+    EXTRAS_AFTER = re.compile(rf"(?<![\w-])(?:{'|'.join(map(re.escape, ACCESSORY_EXTRAS_AFTER))})(?![\w-])")
+    IN_USE = re.compile(rf"(?<![\w-])(?:{'|'.join(map(re.escape, ACCESSORY_IN_USE))})\s+$")
+    CLAUSE_END = re.compile(r"[.,;:!?()\n]")
+
+    def __init__(self, http, fetch_slots=None, request_bucket=None, workers=ENRICH_WORKERS,
+                 cache_size=DETAIL_CACHE_SIZE, cache_ttl=DETAIL_CACHE_TTL):
+        self.http = http
+        # Detail pages count against the same concurrency limit and request budget as result pages
+        self.fetch_slots = fetch_slots or asyncio.Semaphore(FEED_CONCURRENCY)
+        self.request_bucket = request_bucket or TokenBucket(REQUESTS_PER_MINUTE / 60, capacity=FEED_CONCURRENCY)
+        self.workers = workers
+        self.cache = TTLCache(cache_size, cache_ttl)
+
+    async def enrich(self, posts):
+        """Attach details to every post and return the ones that pass the filters."""
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def enrich_one(post):
+            details = self.cache.get(post["id"])
+            if details is None:
+                async with semaphore, self.fetch_slots:
+                    try:
+                        await self.request_bucket.acquire()
+                        html = await self.http.fetch_text(post["link"])
+                        details = self.parse_details(html)
+                    except Exception as e:
+                        # Without details the card is judged on its title alone
+                        logger.error(f"Error fetching details for {post['id']}: {e}")
+                        details = {}
+                if details:
+                    self.cache.set(post["id"], details)
+            return post["id"], details
+
+        # One fetch per listing, even when several chats matched it
+        unique = {post["id"]: post for post in posts}
+        with metrics.timer("enrichment"):
+            details = dict(await asyncio.gather(*(enrich_one(post) for post in unique.values())))
+        for post in posts:
+            post["details"] = details[post["id"]]
+        
+        accepted = []
+        for post in posts:
+            reason = self.rejection_reason(post)
+            if reason:
+                print(f"🚫 Skipping '{post['title']}': {reason}")
+                metrics.increment("enrichment_rejected")
+            else:
+                accepted.append(post)
+        return accepted
+
+    @classmethod
+    def parse_details(cls, html):
+        """Read storage, condition and description from an ad page."""
+        parameters, description, seller = {}, "", None
+        
+        match = HTTPFetcher.PRERENDERED_STATE.search(html)
+        if match:
+            try:
+                ad = json.loads(json.loads(match.group(1)))["ad"]["ad"]
+                description = ad.get("description") or ""
+                seller = str((ad.get("user") or {}).get("id") or "") or None
+                for param in ad.get("params") or []:
+                    parameters[param.get("name") or param.get("key")] = str(param.get("value") or "")
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Error parsing embedded ad state: {e}")
+        
+        if not parameters and not description:
+            parser = DetailHTMLParser()
+            parser.feed(html)
+            parser.close()
+            description = " ".join("".join(parser.description).split())
+            for text in parser.parameters:
+                name, _, value = text.partition(":")
+                parameters[name.strip()] = value.strip()
+        
+        # Strip HTML tags left in descriptions from the embedded state
+        description = " ".join(re.sub(r"<[^>]+>", " ", description).split())
+        condition = next((value for name, value in parameters.items() if name in ("Stan", "state")), None)
+        return {
+            "parameters": parameters,
+            "condition": condition,
+            "storage_gb": cls.storage_gb(" ".join(parameters.values()) + " " + description),
+            "description": description,
+            "seller": seller
+        }
+
+    @classmethod
+    def storage_gb(cls, text):
+        match = cls.STORAGE.search(text or "")
+        if not match:
+            return None
+        size = int(match.group(1))
+        return size * 1024 if match.group(2).lower() == "tb" else size
+
+    @classmethod
+    def negated(cls, text, start, end):
+        """Whether the keyword at text[start:end] is denied by the words around it."""
+        before = cls.CLAUSE_END.split(text[:start])[-1].split()[-2:]
+        after = cls.CLAUSE_END.split(text[end:])[0].split()[:1]
+        return any(word in DAMAGE_NEGATIONS for word in before) or any(word in DAMAGE_NEGATIONS_AFTER for word in after)
+
+    @classmethod
+    def accessory(cls, title):
+        """The first accessory keyword of a lowercase title that isn't just an extra, or None."""
+        # "+etui" is the same as "+ etui"
+        title = title.replace("+", " + ")
+        for match in cls.ACCESSORY.finditer(title):
+            before, after = title[:match.start()], cls.CLAUSE_END.split(title[match.end():])[0]
+            if not (cls.EXTRAS_BEFORE.search(before) or cls.EXTRAS_AFTER.search(after) or cls.IN_USE.search(before)):
+                return match.group(1)
+        return None
+
+    @classmethod
+    def rejection_reason(cls, post):
+        """Why a candidate is not a working phone, or None if it looks fine."""
+        details = post.get("details") or {}
+        title = post["title"].lower()
+        text = f"{title}. {(details.get('description') or '').lower()}"
+        
+        # "iPhone 13 case" is an accessory, "iPhone 13 + etui gratis" a phone with extras
+        accessory = cls.accessory(title)
+        if accessory:
+            return f"accessory ({accessory})"
+        if (details.get("condition") or "").lower().startswith("uszkodz"):
+            return "condition: damaged"
+        for keyword, pattern in cls.DAMAGE:
+            for match in pattern.finditer(text):
+                if not cls.negated(text, match.start(), match.end()):
+                    return f"damaged ({keyword})"
+        return None
+
+
+class ModelMatcher:
+    """Match listing titles against all tracked models in a single pass.
+
+    Plain multi-word patterns ("iPhone 13 Pro") go into an inverted index keyed by
+    one of their words, so only models sharing a word with the title are checked.
+    Every other pattern is merged into one combined regex.
+    """
+
+    def __init__(self, models):
+        self.models = []
+        self.index = {}
+        patterns = []
+        
+        for i, model_data in enumerate(models):
+            # Handle both old format (string) and new format (dict)
+            if isinstance(model_data, str):
+                model_name, max_price = model_data, None
+            else:
+                model_name, max_price = model_data.get("model", ""), model_data.get("max_price")
+            
+            try:
+                regex = re.compile(model_name, re.IGNORECASE)
+                pattern = model_name
+            except re.error as e:
+                logger.error(f"Invalid model pattern '{model_name}', matching it literally: {e}")
+                pattern = re.escape(model_name)
+                regex = re.compile(pattern, re.IGNORECASE)
+            
+            self.models.append((model_name, max_price, regex))
+            
+            # Words after the first one always start at a word boundary in a
+            # matching title, so they can be looked up as token prefixes
+            tokens = model_name.lower().split()
+            if len(tokens) > 1 and re.fullmatch(r"[\w ]+", model_name):
+                key = max(tokens[1:], key=lambda token: (any(c.isdigit() for c in token), len(token)))
+                self.index.setdefault(key, []).append(i)
+            else:
+                patterns.append((i, pattern))
+        
+        # Every remaining model gets an optional lookahead, so a single match()
+        # call on a title reports all of them found anywhere in it
+        self.combined = None
+        self.scanned = [i for i, pattern in patterns]
+        if patterns:
+            try:
+                self.combined = re.compile(
+                    "^" + "".join(f"(?=(?:.*?(?P<m{i}>{pattern}))?)" for i, pattern in patterns),
+                    re.IGNORECASE | re.DOTALL
+                )
+            except re.error:
+                # Patterns with numbered backreferences can't be merged
+                logger.error("Could not combine model patterns, matching them one by one")
+
+    def match_indices(self, title):
+        """Return the positions of every tracked model found in the title."""
+        found = set()
+        
+        if self.index:
+            candidates = set()
+            for token in set(re.findall(r"\w+", title.lower())):
+                for end in range(1, len(token) + 1):
+                    candidates.update(self.index.get(token[:end], ()))
+            found.update(i for i in candidates if self.models[i][2].search(title))
+        
+        if self.combined is not None:
+            matched = self.combined.match(title)
+            found.update(i for i in self.scanned if matched.group(f"m{i}") is not None)
+        else:
+            found.update(i for i in self.scanned if self.models[i][2].search(title))
+        
+        return sorted(found)
+
+    def matches(self, title):
+        """Return (model_name, max_price) for every tracked model found in the title."""
+        return [self.models[i][:2] for i in self.match_indices(title)]
+
+    def match(self, title, price_value):
+        """Return the first matching model within its price limit, or (None, None)."""
+        for model_name, max_price in self.matches(title):
+            # Check price constraint if it exists
+            if max_price is not None and price_value > max_price:
+                print(f"Price too high for {model_name}: {price_value} > {max_price}")
+                continue
+            return model_name, max_price
+        return None, None
+
+
+class RuleEngine:
+    """Compiled model rules evaluated over a whole cycle's listings at once.
+
+    A rule is a tracked model entry; besides "model" and "max_price" it may hold
+    "min_price", "exclude" (keywords), "locations" and "storage" (allowed sizes in GB).
+    Rules come either as one model list for the main chat or as {chat_id: models}
+    for several subscribers; every post matches at most one rule per chat.
+    """
+
+    def __init__(self, models):
+        subscriptions = models if isinstance(models, dict) else {str(CHAT_ID): models}
+        entries = [(chat_id, model_data) for chat_id, chat_models in subscriptions.items()
+                   for model_data in chat_models]
+        
+        self.matcher = ModelMatcher([model_data for chat_id, model_data in entries])
+        self.rules = []
+        for chat_id, model_data in entries:
+            rule = {"model": model_data} if isinstance(model_data, str) else dict(model_data)
+            rule["chat_id"] = str(chat_id)
+            rule["exclude"] = [self.tokenize(keyword) for keyword in rule.get("exclude") or []]
+            rule["locations"] = [self.tokenize(location) for location in rule.get("locations") or []]
+            rule["storage"] = [int(size) for size in rule.get("storage") or []]
+            self.rules.append(rule)
+        
+        # Each exclude keyword / location phrase becomes a column over the token vocabulary
+        self.vocabulary = {}
+        self.exclude_phrases, self.exclude_rules = self.compile_phrases("exclude")
+        self.location_phrases, self.location_rules = self.compile_phrases("locations")
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"\w+", (text or "").lower())
+
+    def compile_phrases(self, field):
+        """Return the phrases used by a field and, per phrase, the rules that use it."""
+        phrases, owners = [], []
+        for i, rule in enumerate(self.rules):
+            for tokens in rule[field]:
+                if not tokens:
+                    continue
+                for token in tokens:
+                    self.vocabulary.setdefault(token, len(self.vocabulary))
+                phrases.append(tokens)
+                owners.append(i)
+        return phrases, owners
+
+    @staticmethod
+    def location_of(post):
+        # "Warszawa, Mokotów - Dzisiaj o 12:30" -> "Warszawa, Mokotów"
+        return post.get("location_time", "").split(" - ")[0]
+
+    @staticmethod
+    def storage_of(post):
+        details = post.get("details") or {}
+        return details.get("storage_gb") or DetailEnricher.storage_gb(post.get("title"))
+
+    def evaluate(self, posts):
+        """Return (post, rule) for every post with a matching rule, first rule wins."""
+        if not posts or not self.rules:
+            return []
+        if not import_numpy():
+            return self.evaluate_python(posts)
+        
+        count, rule_count = len(posts), len(self.rules)
+        
+        # Model patterns: one combined regex pass per title
+        allowed = np.zeros((count, rule_count), dtype=bool)
+        for row, post in enumerate(posts):
+            allowed[row, self.matcher.match_indices(post["title"])] = True
+        
+        # Price limits as a posts x rules comparison
+        prices = np.array([post["price"] for post in posts], dtype=float)
+        min_prices = np.array([rule.get("min_price") or 0 for rule in self.rules], dtype=float)
+        max_prices = np.array([np.inf if rule.get("max_price") is None else rule["max_price"]
+                               for rule in self.rules], dtype=float)
+        allowed &= (prices[:, None] >= min_prices) & (prices[:, None] <= max_prices)
+        
+        # Keywords and locations via token matrices
+        if self.exclude_phrases:
+            titles = self.token_matrix([post["title"] for post in posts])
+            hits = self.phrase_hits(titles, self.exclude_phrases, self.exclude_rules, rule_count)
+            allowed &= ~hits
+        if self.location_phrases:
+            locations = self.token_matrix([self.location_of(post) for post in posts])
+            hits = self.phrase_hits(locations, self.location_phrases, self.location_rules, rule_count)
+            without_filter = np.array([not rule["locations"] for rule in self.rules])
+            allowed &= hits | without_filter
+        
+        # Storage: unknown sizes pass and are checked again once details are known
+        storage_rules = [i for i, rule in enumerate(self.rules) if rule["storage"]]
+        if storage_rules:
+            storage = np.array([self.storage_of(post) or np.nan for post in posts], dtype=float)
+            for i in storage_rules:
+                allowed[:, i] &= np.isnan(storage) | np.isin(storage, self.rules[i]["storage"])
+        
+        # First matching rule of each chat
+        results = []
+        for chat_columns in self.chat_columns():
+            chat_allowed = allowed[:, chat_columns]
+            first = chat_allowed.argmax(axis=1)
+            for row in np.flatnonzero(chat_allowed.any(axis=1)):
+                results.append((posts[row], self.rules[chat_columns[first[row]]]))
+        return results
+
+    def chat_columns(self):
+        """Rule positions grouped by chat, in rule order."""
+        groups = {}
+        for i, rule in enumerate(self.rules):
+            groups.setdefault(rule["chat_id"], []).append(i)
+        return list(groups.values())
+
+    def token_matrix(self, texts):
+        """Posts x vocabulary matrix of token presence."""
+        matrix = np.zeros((len(texts), len(self.vocabulary)), dtype=np.int32)
+        for row, text in enumerate(texts):
+            columns = [self.vocabulary[token] for token in set(self.tokenize(text)) if token in self.vocabulary]
+            matrix[row, columns] = 1
+        return matrix
+
+    def phrase_hits(self, tokens, phrases, owners, rule_count):
+        """Posts x rules matrix: does any of the rule's phrases have all its tokens present."""
+        phrase_tokens = np.zeros((len(self.vocabulary), len(phrases)), dtype=np.int32)
+        for column, phrase in enumerate(phrases):
+            phrase_tokens[[self.vocabulary[token] for token in set(phrase)], column] = 1
+        phrase_found = (tokens @ phrase_tokens) == phrase_tokens.sum(axis=0)
+        
+        phrase_owner = np.zeros((len(phrases), rule_count), dtype=np.int32)
+        phrase_owner[np.arange(len(phrases)), owners] = 1
+        return (phrase_found.astype(np.int32) @ phrase_owner) > 0
+
+    def evaluate_python(self, posts):
+        """Same rules as evaluate(), one post at a time."""
+        results = []
+        for post in posts:
+            title_tokens = set(self.tokenize(post["title"]))
+            location_tokens = set(self.tokenize(self.location_of(post)))
+            storage = self.storage_of(post)
+            chats_done = set()
+            for i in self.matcher.match_indices(post["title"]):
+                rule = self.rules[i]
+                if rule["chat_id"] in chats_done:
+                    continue
+                if self.accepts(rule, post, title_tokens, location_tokens, storage):
+                    results.append((post, rule))
+                    chats_done.add(rule["chat_id"])
+        return results
+
+    @staticmethod
+    def accepts(rule, post, title_tokens, location_tokens, storage):
+        if rule.get("max_price") is not None and post["price"] > rule["max_price"]:
+            return False
+        if post["price"] < (rule.get("min_price") or 0):
+            return False
+        if any(set(phrase) <= title_tokens for phrase in rule["exclude"]):
+            return False
+        if rule["locations"] and not any(set(phrase) <= location_tokens for phrase in rule["locations"]):
+            return False
+        if rule["storage"] and storage and storage not in rule["storage"]:
+            return False
+        return True
+
+    def storage_allowed(self, post, rule):
+        """Re-check a rule's storage filter once the detail page is known."""
+        storage = self.storage_of(post)
+        return not rule["storage"] or not storage or storage in rule["storage"]
+
+
+class PriceHistory:
+    """Append-only columnar price history with per-model rolling percentiles in memory."""
+    # Timestamp, price, post id, model code, location code
+    RECORD = struct.Struct("<dI16sHH")
+    MODEL_PATTERN = re.compile(r"\biphone\s*(\d{1,2}|se|xr|xs|x)\b(?:\s*(pro\s*max|pro|plus|mini|max)\b)?", re.IGNORECASE)
+
+    def __init__(self, directory=PRICE_HISTORY_DIR, days=PRICE_HISTORY_DAYS, writer=None):
+        self.directory = directory
+        self.window = days * 86400
+        self.days = days
+        # Each process writes its own segments and code dictionary
+        self.writer = str(writer or "main")
+        self.models, self.locations = [], []
+        self.codes = {"models": {}, "locations": {}}
+        # Per model: prices sorted for percentiles, and (ts, price) in arrival order to expire them
+        self.sorted_prices = {}
+        self.arrivals = {}
+        self.recent_ids = {}
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    @classmethod
+    def normalize_model(cls, title):
+        """'Apple iphone 13 PRO 128GB' -> 'iPhone 13 Pro', None if no model is named."""
+        match = cls.MODEL_PATTERN.search(title or "")
+        if not match:
+            return None
+        generation, variant = match.groups()
+        name = f"iPhone {generation.upper()}"
+        if variant:
+            name += " " + " ".join(word.capitalize() for word in variant.split())
+        return name
+
+    def code(self, kind, value):
+        """Return the code of a model or location, adding it to the dictionary if new."""
+        codes = self.codes[kind]
+        if value not in codes:
+            values = self.models if kind == "models" else self.locations
+            codes[value] = len(values)
+            values.append(value)
+            JSONHandler.save(self.dictionary_path(self.writer), {"models": self.models, "locations": self.locations})
+        return codes[value]
+
+    def dictionary_path(self, writer):
+        return os.path.join(self.directory, f"{writer}.json")
+
+    def segment_path(self, ts):
+        return os.path.join(self.directory, f"{self.writer}-{datetime.fromtimestamp(ts).strftime('%Y%m%d')}.bin")
+
+    def load(self):
+        """Read the segments inside the window and drop the older ones."""
+        cutoff = time.time() - self.window
+        oldest_day = datetime.fromtimestamp(cutoff).strftime("%Y%m%d")
+        rows = []
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".json"):
+                continue
+            writer = file_name[:-5]
+            dictionary = JSONHandler.load(self.dictionary_path(writer), {})
+            models, locations = dictionary.get("models", []), dictionary.get("locations", [])
+            if writer == self.writer:
+                self.models, self.locations = list(models), list(locations)
+                self.codes = {
+                    "models": {name: i for i, name in enumerate(models)},
+                    "locations": {name: i for i, name in enumerate(locations)}
+                }
+            
+            for segment in sorted(os.listdir(self.directory)):
+                prefix, _, day = segment[:-4].rpartition("-")
+                if prefix != writer or not segment.endswith(".bin"):
+                    continue
+                path = os.path.join(self.directory, segment)
+                if day < oldest_day:
+                    os.remove(path)
+                    continue
+                with open(path, "rb") as file:
+                    data = file.read()
+                # Ignore a record torn by a crash mid-write
+                data = data[:len(data) - len(data) % self.RECORD.size]
+                for ts, price, post_id, model, _ in self.RECORD.iter_unpack(data):
+                    if ts >= cutoff and model < len(models):
+                        rows.append((ts, price, post_id.rstrip(b"\0").decode(), models[model]))
+        
+        for ts, price, post_id, model in sorted(rows):
+            self.insert(ts, price, post_id, model)
+        if rows:
+            print(f"Loaded {len(rows)} listings of price history")
+
+    def insert(self, ts, price, post_id, model):
+        if post_id in self.recent_ids:
+            return False
+        self.recent_ids[post_id] = ts
+        bisect.insort(self.sorted_prices.setdefault(model, []), price)
+        self.arrivals.setdefault(model, deque()).append((ts, price, post_id))
+        return True
+
+    def expire(self, now=None):
+        """Drop listings that fell out of the window from the aggregates."""
+        cutoff = (now or time.time()) - self.window
+        for model, arrivals in self.arrivals.items():
+            prices = self.sorted_prices[model]
+            while arrivals and arrivals[0][0] < cutoff:
+                _, price, post_id = arrivals.popleft()
+                del prices[bisect.bisect_left(prices, price)]
+                self.recent_ids.pop(post_id, None)
+
+    def add_posts(self, posts):
+        """Record every priced listing of a cycle with one append per segment."""
+        now = time.time()
+        self.expire(now)
+        records = []
+        for post in posts:
+            model = self.normalize_model(post["title"])
+            if not model or not post["price"] or not self.insert(now, post["price"], post["id"], model):
+                continue
+            records.append(self.RECORD.pack(
+                now, min(post["price"], 0xFFFFFFFF), post["id"].encode()[:16],
+                self.code("models", model), self.code("locations", RuleEngine.location_of(post))
+            ))
+        
+        if records:
+            try:
+                with open(self.segment_path(now), "ab") as file:
+                    file.write(b"".join(records))
+            except OSError as e:
+                logger.error(f"Error writing price history: {e}")
+        return len(records)
+
+    def percentile_of(self, model, price):
+        """Share of the model's listings that were cheaper, in percent, None with too few samples."""
+        prices = self.sorted_prices.get(model)
+        if not prices or len(prices) < PRICE_MIN_SAMPLES:
+            return None
+        return 100 * bisect.bisect_left(prices, price) / len(prices)
+
+    def deal_score(self, post):
+        """Describe how a listing's price compares with its model's recent listings."""
+        model = self.normalize_model(post["title"])
+        percentile = self.percentile_of(model, post["price"]) if model and post["price"] else None
+        if percentile is None:
+            return None
+        rank = round(percentile)
+        suffix = "th" if 10 <= rank % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(rank % 10, "th")
+        return f"price at {rank}{suffix} percentile for {model} over {self.days} days"
+
+    def stats(self, model=None):
+        """Return {model: (count, p10, median, p90)} from the in-memory aggregates."""
+        result = {}
+        for name, prices in self.sorted_prices.items():
+            if not prices or (model and model.lower() not in name.lower()):
+                continue
+            last = len(prices) - 1
+            result[name] = (len(prices), prices[last // 10], prices[last // 2], prices[last * 9 // 10])
+        return result
+
+
+class ListingArchive:
+    """Append-only archive of every cycle's cards: compressed blobs plus a per-cycle index."""
+
+    def __init__(self, directory=ARCHIVE_DIR, writer=None):
+        self.directory = directory
+        self.writer = str(writer or "main")
+        os.makedirs(directory, exist_ok=True)
+
+    def segment_path(self, ts, suffix):
+        return os.path.join(self.directory, f"{self.writer}-{datetime.fromtimestamp(ts).strftime('%Y%m%d')}.{suffix}")
+
+    def record(self, url, posts):
+        """Append one cycle; the index line is written after the data it points to."""
+        now = time.time()
+        blob = zlib.compress(json.dumps(posts, ensure_ascii=False).encode("utf-8"))
+        try:
+            with open(self.segment_path(now, "bin"), "ab") as file:
+                offset = file.tell()
+                file.write(blob)
+            with open(self.segment_path(now, "idx"), "a", encoding="utf-8") as file:
+                file.write(json.dumps({
+                    "ts": now, "url": url, "offset": offset, "length": len(blob), "posts": len(posts)
+                }) + "\n")
+        except OSError as e:
+            logger.error(f"Error archiving cycle: {e}")
+
+    def tasks(self, since=None, chunk=REPLAY_CHUNK_CYCLES):
+        """Yield (data path, index entries) in chunks of cycles, oldest segments first."""
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(".idx"):
+                continue
+            entries = []
+            with open(os.path.join(self.directory, file_name), encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line torn by a crash
+                    if since and entry["ts"] < since:
+                        continue
+                    entries.append(entry)
+                    if len(entries) >= chunk:
+                        yield os.path.join(self.directory, file_name[:-4] + ".bin"), entries
+                        entries = []
+            if entries:
+                yield os.path.join(self.directory, file_name[:-4] + ".bin"), entries
+
+    @staticmethod
+    def read(path, entries):
+        """Yield (entry, posts) for the given cycles of one segment."""
+        with open(path, "rb") as file:
+            for entry in entries:
+                file.seek(entry["offset"])
+                yield entry, json.loads(zlib.decompress(file.read(entry["length"])))
+
+
+# Rules of a replay worker process, compiled once by init_replay
+replay_rules = None
+
+
+def init_replay(subscriptions):
+    global replay_rules
+    replay_rules = RuleEngine(subscriptions)
+
+
+def replay_chunk(task):
+    """Run the rules over a chunk of archived cycles; returns (cycles, posts checked, matches)."""
+    path, entries = task
+    checked, batch = 0, []
+    for entry, posts in ListingArchive.read(path, entries):
+        checked += len(posts)
+        for post in posts:
+            if post.get("title"):
+                post["ts"] = entry["ts"]
+                batch.append(post)
+    
+    # One evaluation over the whole chunk
+    matches = [
+        (rule["chat_id"], rule["model"], post["id"], post["price"], post["title"], post["ts"])
+        for post, rule in replay_rules.evaluate(batch)
+    ]
+    return len(entries), checked, matches
+
+
+class BrowserSession:
+    """Keep one warm Chrome session across cycles, restarting it when it dies or grows stale."""
+    driver_path = None  # Resolved once per process
+
+    def __init__(self, max_cycles=BROWSER_MAX_CYCLES, max_rss_mb=BROWSER_MAX_RSS_MB):
+        self.max_cycles = max_cycles
+        self.max_rss_mb = max_rss_mb
+        self.driver = None
+        self.cycles = 0
+        self.used = False
+
+    @classmethod
+    def resolve_driver_path(cls):
+        """Resolve the chromedriver binary once, reusing the path cached on disk if it still exists."""
+        if cls.driver_path is None:
+            cached = JSONHandler.load(DRIVER_PATH_FILE, {}).get("path")
+            if cached and os.access(cached, os.X_OK):
+                cls.driver_path = cached
+            else:
+                import_selenium()
+                cls.driver_path = ChromeDriverManager().install()
+                JSONHandler.save(DRIVER_PATH_FILE, {
+                    "path": cls.driver_path,
+                    "resolved_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                })
+        return cls.driver_path
+
+    @classmethod
+    def forget_driver_path(cls):
+        cls.driver_path = None
+        if os.path.exists(DRIVER_PATH_FILE):
+            os.remove(DRIVER_PATH_FILE)
+
+    def create_driver(self):
+        """Start headless Chrome."""
+        import_selenium()
+        options = Options()
+        options.add_argument("--headless")
+        options.add_argument("--no-sandbox")
+        options.add_argument("--disable-dev-shm-usage")
+        options.add_argument("--disable-gpu")
+        options.add_argument(f"--user-agent={USER_AGENT}")
+        if LEAN_BROWSER:
+            options.add_argument("--window-size=1280,800")
+            options.add_argument("--blink-settings=imagesEnabled=false")
+            options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+        else:
+            options.add_argument("--window-size=1920,1080")
+        
+        with metrics.timer("driver_init"):
+            try:
+                driver = webdriver.Chrome(service=Service(self.resolve_driver_path()), options=options)
+            except Exception as e:
+                # After a Chrome update the cached driver no longer fits: resolve it again, once
+                logger.error(f"Chrome failed to start with {self.driver_path}: {e}")
+                self.forget_driver_path()
+                driver = webdriver.Chrome(service=Service(self.resolve_driver_path()), options=options)
+            driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+            if LEAN_BROWSER:
+                # Requests matching these patterns fail before they leave the browser
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BROWSER_BLOCKED_URLS})
+        self.cycles = 0
+        print("WebDriver started")
+        return driver
+
+    def is_alive(self):
+        """Check that the browser still answers commands."""
+        try:
+            self.driver.execute_script("return 1;")
+            return True
+        except Exception as e:
+            logger.error(f"Browser session is not responding: {e}")
+            return False
+
+    def memory_mb(self):
+        """Resident memory of chromedriver and every process below it, None if unknown."""
+        try:
+            root_pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+        
+        # Build the parent -> children map from /proc (Linux only)
+        children = {}
+        try:
+            for entry in os.listdir("/proc"):
+                if not entry.isdigit():
+                    continue
+                try:
+                    with open(f"/proc/{entry}/stat", encoding="utf-8") as file:
+                        ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+                children.setdefault(ppid, []).append(int(entry))
+        except OSError:
+            return None
+        
+        total_kb, pending = 0, [root_pid]
+        while pending:
+            pid = pending.pop()
+            pending.extend(children.get(pid, []))
+            try:
+                with open(f"/proc/{pid}/status", encoding="utf-8") as file:
+                    for line in file:
+                        if line.startswith("VmRSS:"):
+                            total_kb += int(line.split()[1])
+                            break
+            except (OSError, ValueError):
+                continue
+        return total_kb / 1024
+
+    def acquire(self):
+        """Return a healthy driver, starting or recycling Chrome when needed."""
+        if self.driver is not None:
+            reason = None
+            if self.cycles >= self.max_cycles:
+                reason = f"after {self.cycles} cycles"
+            else:
+                rss = self.memory_mb()
+                if rss is not None and rss > self.max_rss_mb:
+                    reason = f"at {rss:.0f} MB RSS"
+                elif not self.is_alive():
+                    reason = "because it stopped responding"
+            if reason:
+                print(f"♻️ Restarting Chrome {reason}")
+                self.quit()
+        
+        if self.driver is None:
+            self.driver = self.create_driver()
+        self.used = True
+        return self.driver
+
+    def end_cycle(self):
+        """Count a scrape cycle that used the browser."""
+        if self.used:
+            self.cycles += 1
+            self.used = False
+
+    def quit(self):
+        """Shut down Chrome."""
+        driver, self.driver = self.driver, None
+        self.used = False
+        if driver:
+            try:
+                driver.quit()
+                print("WebDriver closed")
+            except Exception as e:
+                logger.error(f"Error closing driver: {e}")
 
 
 class OLXScraper:
-    def __init__(self):
-        self.driver = None
+    def __init__(self, base_url=BASE_URL, fetch_backend=FETCH_BACKEND, max_pages=MAX_PAGES, state=None,
+                 enrich_details=ENRICH_DETAILS, prices=None, archive=None, reposts=None):
+        self.base_url = base_url
+        self.prices = prices
+        self.archive = archive
+        self.reposts = reposts
+        self.state = state or StateStore()
+        self.fetch_backend = fetch_backend
+        self.max_pages = max_pages
+        self.http = HTTPFetcher()
+        self.browser = BrowserSession()
+        self.executor = ThreadPoolExecutor(max_workers=BROWSER_WORKERS, thread_name_prefix="browser")
+        # Shared by all feeds and detail fetches: concurrent requests and the request budget
+        self.fetch_slots = asyncio.Semaphore(FEED_CONCURRENCY)
+        self.request_bucket = TokenBucket(REQUESTS_PER_MINUTE / 60, capacity=FEED_CONCURRENCY)
+        self.enricher = DetailEnricher(self.http, self.fetch_slots, self.request_bucket) if enrich_details else None
+        # One feed at a time drives the browser from page load to extraction
+        self.browser_lock = asyncio.Lock()
         self.stop_requested = False
+        self.rules = RuleEngine([])
+        self.rules_key = None
+        self.new_posts_count = 0
+    
+    async def run_blocking(self, func, *args):
+        """Run a blocking browser call on the browser executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
         
     async def initialize(self):
         """Initialize Selenium WebDriver with Chrome."""
-        options = Options()
-        options.add_argument("--headless")
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-dev-shm-usage")
-        options.add_argument("--disable-gpu")
-        options.add_argument("--window-size=1920,1080")
-        options.add_argument("--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-        
-        service = Service(ChromeDriverManager().install())
-        self.driver = webdriver.Chrome(service=service, options=options)
+        await self.run_blocking(self.browser.acquire)
         
     async def close(self):
-        """Close the WebDriver."""
-        if self.driver:
-            try:
-                self.driver.quit()
-                print("WebDriver closed")
-            except Exception as e:
-                logger.error(f"Error closing driver: {e}")
+        """Close the WebDriver and the HTTP client."""
+        await self.http.close()
+        # Not on the browser executor: it may be stuck in a page load that
+        # quitting Chrome is meant to abort
+        await asyncio.to_thread(self.browser.quit)
     
-    async def scrape(self, bot, models, seen_posts, status):
-        """Scrape OLX.pl for iPhone listings based on tracked models."""
-        if not self.driver:
-            await self.initialize()
+    @staticmethod
+    def parse_price(price_text):
+        """Extract the numeric price from an OLX price label, 0 if there is none."""
+        price_match = re.search(r'(\d[\d\s]*)', price_text)
+        if price_match:
+            return int(re.sub(r'\s', '', price_match.group(1)))
+        return 0
+    
+    @staticmethod
+    def build_post(raw):
+        """Turn a raw card dict into a plain post record used by the scrape loop."""
+        post_link = raw.get("link")
+        if not post_link:
+            return None
+        
+        # Extract post ID from the link, falling back to the card id
+        post_id = re.search(r"ID([a-zA-Z0-9]+)\.html", post_link)
+        post_id = post_id.group(1) if post_id else (raw.get("card_id") or post_link)
+        
+        price_text = raw.get("price_text") or "Price not found"
+        return {
+            "id": post_id,
+            "link": post_link,
+            "title": (raw.get("title") or "").strip(),
+            "price_text": price_text,
+            "price": OLXScraper.parse_price(price_text),
+            "location_time": raw.get("location_time") or "Unknown location and time",
+            "promoted": bool(raw.get("promoted")),
+            "seller": raw.get("seller")
+        }
+    
+    @classmethod
+    def build_posts(cls, raw_cards):
+        """Build post records from raw cards, skipping cards without a link."""
+        posts = []
+        for raw in raw_cards:
+            post = cls.build_post(raw)
+            if post:
+                posts.append(post)
+        return posts
+    
+    def extract_cards(self):
+        """Extract all listing cards from the loaded page with one execute_script call."""
+        raw_cards = self.browser.driver.execute_script(EXTRACT_CARDS_SCRIPT) or []
+        return self.build_posts(raw_cards)
+    
+    def update_rules(self, models):
+        """Compile a new RuleEngine if the tracked models changed since the last cycle."""
+        key = json.dumps(models, sort_keys=True, ensure_ascii=False)
+        if key != self.rules_key:
+            self.rules = RuleEngine(models)
+            self.rules_key = key
+            print(f"Compiled rules for {len(self.rules.rules)} models")
+    
+    def page_url(self, page, base_url=None):
+        """Return the search URL for the given result page (1-based)."""
+        base_url = base_url or self.base_url
+        if page <= 1:
+            return base_url
+        separator = "&" if "?" in base_url else "?"
+        return f"{base_url}{separator}page={page}"
+    
+    async def fetch_posts_http(self, url, previous=None):
+        """Fetch listing cards over plain HTTP as (posts, fingerprint), None if the lightweight parse fails."""
+        try:
+            print(f"Fetching {url} over HTTP...")
+            raw_cards, fingerprint = await self.http.fetch(url, previous)
+        except Exception as e:
+            logger.error(f"HTTP fetch failed: {e}")
+            return None
+        
+        if raw_cards is None:
+            return None, fingerprint
+        posts = self.build_posts(raw_cards)
+        return (posts, fingerprint) if posts else None
+    
+    def open_page(self, url):
+        """Load a search page and wait for the cards; blocking, runs on the browser executor."""
+        # The stop may have come while this call waited for the executor
+        if self.stop_requested:
+            raise RuntimeError("Scraper is stopping")
+        driver = self.browser.acquire()
+        
+        # Load the page once; the extra query parameter keeps caches from serving a stale list
+        separator = "&" if "?" in url else "?"
+        driver.get(f"{url}{separator}_={int(time.time() * 1000)}")
+        
+        # Wait for the posts to load
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.CSS_SELECTOR, "[data-cy='l-card']"))
+        )
+        
+        # Fingerprint of the first cards, before any scrolling
+        links = driver.execute_script(FIRST_LINKS_SCRIPT, FINGERPRINT_CARDS) or []
+        return HTTPFetcher.fingerprint("\n".join(links))
+    
+    def wait_for_cards(self):
+        """Wait until the card count stops growing instead of sleeping a fixed time."""
+        driver = self.browser.driver
+        counts = []
+        
+        # Scroll to the bottom to trigger dynamic content loading
+        print("Scrolling to load dynamic content...")
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        
+        def settled(driver):
+            counts.append(driver.execute_script("return document.querySelectorAll(\"[data-cy='l-card']\").length;"))
+            return len(counts) >= 2 and counts[-1] == counts[-2]
         
         try:
-            # Initial page load
-            print("\n" + "="*50)
-            print(f"🔍 STARTING SEARCH FOR IPHONE MODELS")
-            print("="*50)
-            
-            # Clear cookies and storage to prevent stale cache
-            print("Clearing cookies and browser storage...")
-            self.driver.delete_all_cookies()
-            self.driver.execute_script("localStorage.clear(); sessionStorage.clear();")
+            WebDriverWait(driver, CARD_WAIT_TIMEOUT, poll_frequency=CARD_WAIT_POLL).until(settled)
+        except TimeoutException:
+            print(f"⚠️ Cards still loading after {CARD_WAIT_TIMEOUT}s, extracting {counts[-1] if counts else 0}")
+    
+    def page_transfer(self):
+        """Bytes, requests and load time of the current page from the Resource Timing API."""
+        return self.browser.driver.execute_script(PAGE_TRANSFER_SCRIPT) or {}
+    
+    async def fetch_posts_selenium(self, url, previous=None):
+        """Load the search page in headless Chrome and return (posts, fingerprint).
+        
+        Posts are None when the fingerprint equals `previous`; scrolling and
+        extraction are skipped then.
+        """
+        async with self.browser_lock:
+            if self.stop_requested:
+                return [], None
+            with metrics.timer("page_load"):
+                fingerprint = await self.run_blocking(self.open_page, url)
+            if previous and fingerprint == previous:
+                return None, fingerprint
+            with metrics.timer("card_wait"):
+                await self.run_blocking(self.wait_for_cards)
             
-            # Load the page
-            self.driver.get(BASE_URL)
+            transfer = await self.run_blocking(self.page_transfer)
+            if transfer:
+                print(f"📦 Page: {transfer['bytes'] / 1024:.0f} KB over {transfer['requests']} requests, "
+                      f"loaded in {transfer['load_ms'] / 1000:.1f}s")
+                metrics.increment("page_bytes", transfer["bytes"])
+                metrics.increment("page_requests", transfer["requests"])
             
-            # Refresh the page to ensure a fresh load
-            print("Refreshing page...")
-            self.driver.refresh()
+            with metrics.timer("extraction"):
+                return await self.run_blocking(self.extract_cards), fingerprint
+    
+    async def fetch_posts(self, url, previous=None, backend=None):
+        """Get (posts, fingerprint) of one page using the feed's or the configured fetch backend.
+        
+        Posts are None when the page's fingerprint equals `previous`.
+        """
+        # Every page fetch of every feed counts against the shared budget
+        async with self.fetch_slots:
+            await self.request_bucket.acquire()
+            if (backend or self.fetch_backend) == "http":
+                result = await self.fetch_posts_http(url, previous)
+                if result is not None:
+                    return result
+                # stop() closes the HTTP client under a running fetch; don't start Chrome then
+                if self.stop_requested:
+                    return [], None
+                print("⚠️ HTTP parse failed, falling back to Selenium")
+            return await self.fetch_posts_selenium(url, previous)
+    
+    async def iter_new_posts(self, base_url, watermark, result, fingerprint=None, backend=None, max_pages=None):
+        """Walk result pages newest first until the previous cycle's watermark is reached.
+        
+        Yields the new posts of each page as soon as it is loaded. The newest ids
+        and the first page's fingerprint are left in `result`, which also gets
+        "unchanged" when the first page matches `fingerprint`.
+        """
+        watermark = set(watermark.get("ids", []))
+        collected = set()
+        result.update(newest_ids=[], fingerprint=None, unchanged=False)
+        
+        max_pages = max_pages or self.max_pages
+        for page in range(1, max_pages + 1):
+            if self.stop_requested:
+                break
             
-            # Wait for the posts to load
-            WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, "[data-cy='l-card']"))
+            posts, page_fingerprint = await self.fetch_posts(
+                self.page_url(page, base_url), fingerprint if page == 1 and watermark else None, backend
             )
+            if page == 1:
+                result["fingerprint"] = page_fingerprint
+                if posts is None:
+                    result["unchanged"] = True
+                    return
+            if not posts:
+                break
             
-            # Scroll to the bottom to trigger dynamic content loading
-            print("Scrolling to load dynamic content...")
-            self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            await asyncio.sleep(2)  # Short delay to allow content to load
-            
-            # Get all posts
-            posts = self.driver.find_elements(By.CSS_SELECTOR, "[data-cy='l-card']")
-            print(f"Found {len(posts)} posts on OLX")
-            
-            # Debug: Log the first 5 listing titles
-            print("\n🔍 DEBUG: First 5 listing titles:")
-            for i, post in enumerate(posts[:5]):
-                try:
-                    title = post.find_element(By.CSS_SELECTOR, "h4, h6").text.strip()
-                    print(f"  {i+1}. {title}")
-                except Exception as e:
-                    print(f"  {i+1}. Error retrieving title: {e}")
-            print()
+            if page == 1:
+                result["newest_ids"] = [post["id"] for post in posts if not post["promoted"]][:WATERMARK_SIZE]
             
-            # Update status
-            status["last_check"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            JSONHandler.save(STATUS_FILE, status)
+            reached, new_posts = False, []
+            for post in posts:
+                # Promoted cards are pinned to the top regardless of age
+                if post["promoted"]:
+                    if post["id"] not in collected:
+                        collected.add(post["id"])
+                        new_posts.append(post)
+                    continue
+                
+                if post["id"] in watermark:
+                    reached = True
+                    break
+                # Listings shift between page loads, so skip ones already collected
+                if post["id"] not in collected:
+                    collected.add(post["id"])
+                    new_posts.append(post)
             
-            # Process posts
-            checked, matched, already_seen = 0, 0, 0
+            if new_posts:
+                yield new_posts
             
-            for post in posts[:30]:  # Limit to first 30 posts
+            # Without a watermark (first run) only the first page is scanned
+            if reached or not watermark:
+                break
+        else:
+            if watermark:
+                print(f"⚠️ Watermark not reached within {max_pages} pages")
+    
+    async def fetch_stage(self, shard, result, stats, pages):
+        """Pipeline stage: load result pages and pass each page's new posts on."""
+        try:
+            async for posts in self.iter_new_posts(
+                shard["url"], shard["watermark"], result, shard.get("fingerprint"),
+                shard.get("backend"), shard.get("max_pages")
+            ):
+                if stats["new_posts"] == 0:
+                    # Debug: Log the first 5 listing titles
+                    print("\n🔍 DEBUG: First 5 listing titles:")
+                    for i, post in enumerate(posts[:5]):
+                        print(f"  {i+1}. {post['title'] or 'Title not found'}")
+                    print()
+                stats["new_posts"] += len(posts)
+                # Promoted cards come back every cycle, so only organic ones tell the listing rate
+                stats["new_organic"] += sum(not post["promoted"] for post in posts)
+                print(f"Found {len(posts)} new posts on OLX")
+                
+                # Every priced listing goes into the history, matched or not
+                if self.prices:
+                    self.prices.add_posts(posts)
+                if self.archive:
+                    self.archive.record(shard["url"], posts)
+                await pages.put(posts)
+        finally:
+            await pages.put(None)
+    
+    async def match_stage(self, seen_posts, stats, pages, candidates, workers):
+        """Pipeline stage: match a page against every subscriber's rules and drop seen posts."""
+        try:
+            while (posts := await pages.get()) is not None:
                 if self.stop_requested:
-                    break
-                    
-                try:
-                    checked += 1
+                    continue
+                stats["checked"] += len(posts)
+                
+                # Evaluate every subscriber's rules over the whole page at once
+                started = time.perf_counter()
+                results = self.rules.evaluate([post for post in posts if post["title"]])
+                stats["match_time"] += time.perf_counter() - started
+                
+                # Fan out: each chat keeps its own seen-state
+                for post, rule in results:
+                    started = time.perf_counter()
+                    chat_id = rule["chat_id"]
+                    if SeenPostsStore.key(post["id"], chat_id) in seen_posts:
+                        stats["already_seen"] += 1
+                        stats["dedup_time"] += time.perf_counter() - started
+                        continue
                     
-                    # Extract post ID and link
-                    post_link = post.find_element(By.CSS_SELECTOR, "a").get_attribute("href")
-                    post_id = re.search(r"ID([a-zA-Z0-9]+)\.html", post_link)
-                    post_id = post_id.group(1) if post_id else post_link
+                    stats["matched"] += 1
                     
-                    # Skip if already seen
-                    if post_id in seen_posts:
-                        already_seen += 1
+                    # Check for duplicates
+                    duplicate = seen_posts.has_link(SeenPostsStore.key(post["link"], chat_id))
+                    stats["dedup_time"] += time.perf_counter() - started
+                    if duplicate:
                         continue
                     
-                    # Extract title
-                    try:
-                        title = post.find_element(By.CSS_SELECTOR, "h4, h6").text.strip()
-                    except:
+                    await candidates.put(dict(
+                        post, model=rule["model"], max_price=rule.get("max_price"), rule=rule, chat_id=chat_id
+                    ))
+        finally:
+            for _ in range(workers):
+                await candidates.put(None)
+    
+    async def notify_stage(self, notifier, status, stats, candidates):
+        """Pipeline stage: check a candidate's details and reposts, then notify it right away."""
+        while (post := await candidates.get()) is not None:
+            try:
+                # Read the detail page to drop accessories and damaged phones
+                if self.enricher and not self.stop_requested:
+                    if not await self.enricher.enrich([post]) or not self.rules.storage_allowed(post, post["rule"]):
                         continue
-                    
-                    # Extract price
-                    try:
-                        price_element = post.find_element(By.CSS_SELECTOR, "p[data-testid='ad-price']")
-                        price_text = price_element.text.strip()
-                        # Extract numeric price
-                        price_match = re.search(r'(\d[\d\s]*)', price_text)
-                        if price_match:
-                            price_str = price_match.group(1).replace(" ", "")
-                            price_value = int(price_str)
-                        else:
-                            price_value = 0  # If price can't be extracted
-                    except:
-                        price_text = "Price not found"
-                        price_value = 0
-                    
-                    # Check if the post matches any of the tracked models
-                    matching_model = None
-                    max_price = None
-                    
-                    for model_data in models:
-                        # Handle both old format (string) and new format (dict)
-                        if isinstance(model_data, str):
-                            model_name = model_data
-                            model_max_price = None
-                        else:
-                            model_name = model_data.get("model", "")
-                            model_max_price = model_data.get("max_price")
-                        
-                        model_regex = re.compile(model_name, re.IGNORECASE)
-                        if model_regex.search(title):
-                            # Check price constraint if it exists
-                            if model_max_price is not None and price_value > model_max_price:
-                                print(f"Price too high for {model_name}: {price_value} > {model_max_price}")
-                                continue
-                                
-                            matching_model = model_name
-                            max_price = model_max_price
-                            break
-                    
-                    if matching_model:
-                        matched += 1
-                        # Extract location and time
-                        try:
-                            location_time = post.find_elements(By.CSS_SELECTOR, "p[data-testid='location-date']")
-                            location_time_text = location_time[0].text if location_time else "Unknown location and time"
-                        except:
-                            location_time_text = "Unknown location and time"
-                        
-                        # Check for duplicates
-                        duplicate = any(seen_data.get("link") == post_link for seen_id, seen_data in seen_posts.items())
-                        
-                        if not duplicate:
-                            # Create message
-                            price_info = f"{price_text}"
-                            if max_price:
-                                price_info += f" (Max: {max_price} zł)"
-                                
-                            message = (
-                                f"🔔 <b>New iPhone Listing</b> 🔔\n\n"
-                                f"📱 <b>Model:</b> {matching_model}\n"
-                                f"💰 <b>Price:</b> {price_info}\n"
-                                f"📍 <b>Details:</b> {location_time_text}\n"
-                                f"🔗 <b>Link:</b> <a href=\"{post_link}\">{title}</a>\n\n"
-                                f"<b>Title:</b> {title}"
-                            )
-                            
-                            # Send notification
-                            await bot.send_message(
-                                chat_id=CHAT_ID,
-                                text=message,
-                                parse_mode='HTML',
-                                disable_web_page_preview=False
-                            )
-                            
-                            # Mark as seen and update stats
-                            seen_posts[post_id] = {
-                                "title": title,
-                                "model": matching_model,
-                                "price": price_text,
-                                "link": post_link,
-                                "found_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            status["total_posts_found"] += 1
-                            
-                            # Save updated data
-                            JSONHandler.save(SEEN_POSTS_FILE, seen_posts)
-                            JSONHandler.save(STATUS_FILE, status)
-                            
-                            print(f"✅ Match found: {matching_model} - {price_text}")
                 
-                except Exception as e:
-                    logger.error(f"Error processing post: {e}")
+                # A deleted and reposted listing under a new id
+                original = self.reposts.find(post, post["chat_id"]) if self.reposts else None
+                if original:
+                    print(f"♻️ Skipping repost of {original}: {post['title']}")
+                    stats["suppressed"] += 1
                     continue
+                
+                # False when another worker notified the post first
+                if await self.notify(notifier, post):
+                    # Time from the start of the cycle until the first alert was queued
+                    if not stats.get("alerted"):
+                        stats["alerted"] = True
+                        metrics.observe("first_alert", time.perf_counter() - stats["started"])
+                    status["total_posts_found"] += 1
+                    if self.reposts:
+                        self.reposts.add(post, post["chat_id"])
+            except Exception as e:
+                # Counted so the watermark stays put and the post is retried next cycle
+                logger.error(f"Error processing post {post['id']}: {e}")
+                stats["failed"] += 1
+    
+    async def notify(self, notifier, post):
+        """Build the notification for a matched post and queue it."""
+        price_info = f"{post['price_text']}"
+        if post["max_price"]:
+            price_info += f" (Max: {post['max_price']} zł)"
+        
+        details_info = ""
+        details = post.get("details") or {}
+        if details.get("storage_gb"):
+            details_info += f"💾 <b>Storage:</b> {details['storage_gb']} GB\n"
+        if details.get("condition"):
+            details_info += f"🏷️ <b>Condition:</b> {escape(details['condition'])}\n"
+        
+        deal = self.prices.deal_score(post) if self.prices else None
+        if deal:
+            details_info += f"📊 <b>Deal:</b> {escape(deal)}\n"
+        
+        # Titles and the rest come from sellers; "<" or "&" would make Telegram reject the message
+        title = escape(str(post['title']))
+        message = (
+            f"🔔 <b>New iPhone Listing</b> 🔔\n\n"
+            f"📱 <b>Model:</b> {escape(str(post['model']))}\n"
+            f"💰 <b>Price:</b> {escape(price_info)}\n"
+            f"{details_info}"
+            f"📍 <b>Details:</b> {escape(str(post['location_time']))}\n"
+            f"🔗 <b>Link:</b> <a href=\"{escape(post['link'])}\">{title}</a>\n\n"
+            f"<b>Title:</b> {title}"
+        )
+        
+        # Queue notification; the post is marked as seen once it is delivered
+        queued = await notifier.submit(post["id"], message, {
+            "title": post["title"],
+            "model": post["model"],
+            "price": post["price_text"],
+            "link": post["link"],
+            "found_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }, chat_id=post.get("chat_id"))
+        if queued:
+            print(f"✅ Match found: {post['model']} - {post['price_text']}")
+        return queued
+    
+    async def scrape(self, notifier, subscriptions, seen_posts, status, shard=None):
+        """Scrape OLX.pl for iPhone listings based on tracked models.
+        
+        In worker mode `shard` is the leased search ({"url", "watermark"}); its
+        watermark is updated in place instead of the one in the status.
+        """
+        if shard is None:
+            shard = {
+                "url": self.base_url,
+                "watermark": status.get("watermark", {}),
+                "fingerprint": status.get("fingerprint")
+            }
+            status_watermark = True
+        else:
+            status_watermark = False
+        
+        try:
+            # Initial page load
+            print("\n" + "="*50)
+            print(f"🔍 STARTING SEARCH FOR IPHONE MODELS")
+            print("="*50)
+            
+            # Rebuild the rules only when the tracked models change
+            self.update_rules(subscriptions)
+            seen_posts.sync()
+            if self.reposts:
+                self.reposts.sync()
+            
+            # fetch -> match/dedup -> enrich/notify, overlapping through bounded queues,
+            # so the first match is notified while later pages are still loading
+            result, stats = {}, dict.fromkeys(
+                ("new_posts", "new_organic", "checked", "matched", "already_seen", "suppressed", "failed", "match_time", "dedup_time"), 0
+            )
+            stats["started"] = time.perf_counter()
+            pages = asyncio.Queue(maxsize=PIPELINE_PAGE_QUEUE)
+            candidates = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            workers = ENRICH_WORKERS if self.enricher else 1
+            stages = [
+                asyncio.create_task(self.fetch_stage(shard, result, stats, pages)),
+                asyncio.create_task(self.match_stage(seen_posts, stats, pages, candidates, workers)),
+                *(asyncio.create_task(self.notify_stage(notifier, status, stats, candidates)) for _ in range(workers))
+            ]
+            try:
+                await asyncio.gather(*stages)
+            finally:
+                for stage in stages:
+                    stage.cancel()
+            
+            self.new_posts_count = shard["new_posts"] = stats["new_posts"]
+            shard["new_organic"] = stats["new_organic"]
+            newest_ids, fingerprint = result["newest_ids"], result["fingerprint"]
+            status["last_check"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            
+            # Nothing new at the top of the list: the rest of the cycle found nothing
+            if result["unchanged"]:
+                print("💤 First page unchanged since the last cycle, skipping")
+                status["skipped_cycles"] = status.get("skipped_cycles", 0) + 1
+                self.state.set("status", status)
+                metrics.increment("cycles_skipped")
+                return True
+            
+            checked, matched = stats["checked"], stats["matched"]
+            already_seen, suppressed = stats["already_seen"], stats["suppressed"]
+            metrics.observe("matching", stats["match_time"])
+            metrics.observe("dedup", stats["dedup_time"])
+            metrics.increment("posts_checked", checked)
+            metrics.increment("posts_already_seen", already_seen)
+            metrics.increment("matches", matched)
+            metrics.increment("reposts_suppressed", suppressed)
+            metrics.increment("posts_failed", stats["failed"])
+            
+            # Move the watermark only after a complete pass, so a stopped cycle is rescanned,
+            # and only when every match was handled, so a failed one is tried again
+            if stats["failed"]:
+                print(f"⚠️ {stats['failed']} matches failed, keeping the watermark to retry them")
+            if newest_ids and not self.stop_requested and not stats["failed"]:
+                shard["watermark"] = {
+                    "ids": newest_ids,
+                    "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                }
+                shard["fingerprint"] = fingerprint
+                if status_watermark:
+                    status["watermark"] = shard["watermark"]
+                    status["fingerprint"] = fingerprint
+            
+            # Save updated status once per cycle
+            self.state.set("status", status)
                     
             # Print summary
             print("-"*50)
@@ -272,6 +2996,8 @@ class OLXScraper:
             print(f"- Posts checked: {checked}")
             print(f"- Posts already seen: {already_seen}")
             print(f"- New matching posts: {matched}")
+            print(f"- Reposts suppressed: {suppressed}")
+            print(f"- Failed, retried next cycle: {stats['failed']}")
             print(f"- Total matches found (all time): {status['total_posts_found']}")
             print("-"*50)
             
@@ -280,74 +3006,366 @@ class OLXScraper:
         except Exception as e:
             logger.error(f"Error during scraping: {e}")
             return False
+        
+        finally:
+            # Never lose posts that were already notified
+            seen_posts.flush()
+            self.browser.end_cycle()
 
 
 class OLXScraperBot:
-    def __init__(self):
-        self.scraper = OLXScraper()
+    def __init__(self, worker_id=WORKER_ID):
+        self.state = StateStore(status_file=self.status_file(worker_id))
+        self.scraper = OLXScraper(state=self.state)
+        self.worker_id = worker_id
+        self.leases = None
+        self.lease_task = None
         self.running = False
         self.task = None
+        self.seen_posts = None
+        self.notifier = None
+        self.scheduler = PollScheduler()
+        self.feed_schedulers = {}
+        self.feed_due = {}
+        self.config_changed = False
+        self.command_latency = {}
+        # Seconds from process start until polling began and until the first reply
+        self.ready_after = None
+        self.first_response = None
+        self.warm_up_task = None
+        self.compact_task = None
+        self.compact_due = 0
+        # Resident memory when polling started, to compare long uptimes against
+        self.rss_at_start = None
+    
+    def record_latency(self, command, seconds):
+        """Remember how long a command handler took to respond."""
+        samples = self.command_latency.setdefault(command, deque(maxlen=LATENCY_SAMPLES))
+        samples.append(seconds)
+        logger.info(f"Handled {command} in {seconds * 1000:.1f} ms")
+    
+    def latency_summary(self):
+        """Return {command: (average_ms, max_ms)} over the recent samples."""
+        return {
+            command: (sum(samples) / len(samples) * 1000, max(samples) * 1000)
+            for command, samples in self.command_latency.items() if samples
+        }
+    
+    def load_models(self, chat_id=CHAT_ID):
+        if str(chat_id) == str(CHAT_ID):
+            return self.state.get("models")
+        return self.state.get("subscriptions").get(str(chat_id), [])
+    
+    def save_models(self, models, chat_id=CHAT_ID):
+        if str(chat_id) == str(CHAT_ID):
+            return self.state.set("models", models)
+        subscriptions = self.state.get("subscriptions")
+        subscriptions[str(chat_id)] = models
+        return self.state.set("subscriptions", subscriptions)
+    
+    @staticmethod
+    def may_subscribe(chat_id):
+        return str(chat_id) in {str(allowed) for allowed in SUBSCRIBER_CHAT_IDS}
+    
+    def command_chat(self, chat_id):
+        """Chat whose models a command manages: a subscribed chat its own, anyone else CHAT_ID's."""
+        if self.may_subscribe(chat_id) and str(chat_id) in self.state.get("subscriptions"):
+            return chat_id
+        return CHAT_ID
+    
+    def subscribe(self, chat_id):
+        """Give an allowed chat models and alerts of its own; False if it may not subscribe."""
+        if not self.may_subscribe(chat_id):
+            return False
+        subscriptions = self.state.get("subscriptions")
+        subscriptions.setdefault(str(chat_id), [])
+        return self.state.set("subscriptions", subscriptions)
     
-    def load_models(self):
-        return JSONHandler.load(MODELS_FILE, [])
+    def unsubscribe(self, chat_id):
+        subscriptions = self.state.get("subscriptions")
+        if subscriptions.pop(str(chat_id), None) is None:
+            return False
+        return self.state.set("subscriptions", subscriptions)
     
-    def save_models(self, models):
-        return JSONHandler.save(MODELS_FILE, models)
+    def load_subscriptions(self):
+        """Return {chat_id: models} for CHAT_ID and every allowed subscribed chat that tracks something."""
+        subscriptions = {str(CHAT_ID): self.load_models()}
+        subscriptions.update(
+            (chat_id, models) for chat_id, models in self.state.get("subscriptions").items()
+            if self.may_subscribe(chat_id)
+        )
+        return {chat_id: models for chat_id, models in subscriptions.items() if models}
     
     def load_seen_posts(self):
-        return JSONHandler.load(SEEN_POSTS_FILE, {})
+        if self.seen_posts is None:
+            self.seen_posts = SeenPostsStore(SEEN_POSTS_DB, filter_path=SEEN_FILTER_FILE)
+            self.seen_posts.migrate_json(SEEN_POSTS_FILE)
+        return self.seen_posts
+    
+    @staticmethod
+    def status_file(worker_id):
+        """Status file of a worker, so workers don't overwrite each other's counters and running flag."""
+        if worker_id is None or str(worker_id) == WORKER_ID:
+            return STATUS_FILE
+        root, ext = os.path.splitext(STATUS_FILE)
+        return f"{root}.{worker_id}{ext}"
     
     def load_status(self):
-        status = JSONHandler.load(STATUS_FILE, DEFAULT_STATUS)
+        status = self.state.get("status")
         # Update models_tracked from models file
         status["models_tracked"] = self.load_models()
         return status
     
     def save_status(self, status):
-        return JSONHandler.save(STATUS_FILE, status)
+        return self.state.set("status", status)
+    
+    async def keep_leases(self, leases):
+        """Renew the heartbeat and held leases every third of their TTL while running.
+        
+        Feeds are only balanced when some are due, which can take longer than the
+        TTL; a live worker must not lose its feeds and outbox to another meanwhile.
+        """
+        while True:
+            await asyncio.sleep(leases.ttl / 3)
+            try:
+                leases.renew()
+            except sqlite3.Error as e:
+                logger.error(f"Error renewing leases: {e}")
+    
+    async def compact_seen_posts(self, seen_posts):
+        """Expire and compact the seen posts in a thread, then switch to the rebuilt filter."""
+        started = time.perf_counter()
+        bloom, rowid, deleted = await asyncio.to_thread(seen_posts.compact)
+        if bloom is None:
+            metrics.error("compaction")
+            return
+        seen_posts.install_filter(bloom, rowid)
+        seen_posts.save_filter()
+        seen_posts.last_compaction = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        metrics.observe("compaction", time.perf_counter() - started)
+        print(f"🧹 Seen posts compacted: {deleted} expired, filter rebuilt with {bloom.count} keys")
+    
+    @staticmethod
+    def process_memory():
+        """Current and peak resident memory in bytes, None where the platform doesn't tell."""
+        rss = peak = None
+        try:
+            with open("/proc/self/statm") as file:
+                rss = int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import resource
+            # Kilobytes on Linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        except ImportError:
+            pass
+        return rss, peak
+    
+    def memory_report(self):
+        """Process memory and the size of everything that grows with uptime."""
+        rss, peak = self.process_memory()
+        report = {"rss": rss, "peak": peak, "rss_at_start": self.rss_at_start}
+        report.update(self.load_seen_posts().memory_report())
+        report["detail_cache"] = len(self.scraper.enricher.cache) if self.scraper.enricher else 0
+        report["repost_index"] = len(self.scraper.reposts.entries) if self.scraper.reposts else 0
+        report["price_history"] = sum(map(len, self.scraper.prices.sorted_prices.values())) if self.scraper.prices else 0
+        report["metric_samples"] = sum(map(len, metrics.snapshot()[0].values()))
+        return report
+    
+    async def warm_up(self):
+        """Resolve chromedriver, and start Chrome for the Selenium backend, in the background."""
+        started = time.perf_counter()
+        try:
+            if self.scraper.fetch_backend == "selenium":
+                await self.scraper.initialize()
+            else:
+                # Only needed for the Selenium fallback, but then without a download
+                await asyncio.to_thread(BrowserSession.resolve_driver_path)
+            print(f"🔥 Browser warmed up in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Browser warm-up failed: {e}")
+    
+    def load_price_history(self):
+        if self.scraper.prices is None:
+            self.scraper.prices = PriceHistory(PRICE_HISTORY_DIR, writer=self.worker_id)
+        return self.scraper.prices
+    
+    def load_reposts(self):
+        if self.scraper.reposts is None and REPOST_WINDOW_DAYS:
+            self.scraper.reposts = RepostDetector(SEEN_POSTS_DB)
+        return self.scraper.reposts
+    
+    def load_archive(self):
+        if self.scraper.archive is None and ARCHIVE_DIR:
+            self.scraper.archive = ListingArchive(ARCHIVE_DIR, writer=self.worker_id)
+        return self.scraper.archive
+    
+    def load_leases(self):
+        if self.leases is None and self.worker_id is not None:
+            self.leases = LeaseStore(SEEN_POSTS_DB, self.worker_id)
+        return self.leases
+    
+    def load_feeds(self):
+        """Return the feed registry with defaults filled in, highest priority first."""
+        feeds = []
+        for i, feed in enumerate(self.state.get("feeds") or DEFAULT_FEEDS):
+            if not feed.get("url"):
+                continue
+            parser = feed.get("parser", "olx")
+            if parser not in PARSER_PROFILES:
+                logger.error(f"Unknown parser profile {parser!r} for feed {feed.get('name')}, using 'olx'")
+                parser = "olx"
+            priority = feed.get("priority", 2)
+            feeds.append(dict(
+                feed, name=feed.get("name") or f"feed{i + 1}", parser=parser,
+                priority=priority if priority in PRIORITY_INTERVAL_FACTORS else 2
+            ))
+        return sorted(feeds, key=lambda feed: feed["priority"])
+    
+    def feed_scheduler(self, feed, check_interval):
+        """Each feed adapts its own polling interval to its listing rate."""
+        scheduler = self.feed_schedulers.get(feed["name"])
+        if scheduler is None:
+            scheduler = self.feed_schedulers[feed["name"]] = PollScheduler()
+        scheduler.base_interval = check_interval
+        return scheduler
+    
+    async def scrape_feed(self, feed, notifier, subscriptions, seen_posts, status):
+        """Scrape one feed from its saved watermark; returns (success, new organic posts)."""
+        leases = self.load_leases()
+        # Watermarks kept in the status before the feed was leased carry over
+        saved = status.get("feeds", {}).get(feed["name"], {})
+        if leases:
+            saved = leases.load_state(feed["url"]) or saved
+        profile = PARSER_PROFILES[feed["parser"]]
+        shard = {
+            "name": feed["name"],
+            "url": feed["url"],
+            "backend": profile["backend"],
+            "max_pages": profile["max_pages"],
+            "watermark": saved.get("watermark", {}),
+            "fingerprint": saved.get("fingerprint")
+        }
+        
+        print(f"\n📡 Feed {feed['name']} (priority {feed['priority']})")
+        success = await self.scraper.scrape(notifier, subscriptions, seen_posts, status, shard)
+        
+        state = {"watermark": shard["watermark"], "fingerprint": shard.get("fingerprint")}
+        if leases:
+            leases.save_state(feed["url"], state)
+        else:
+            status.setdefault("feeds", {})[feed["name"]] = state
+            self.save_status(status)
+        return success, shard.get("new_organic", 0)
+    
+    async def run_cycle(self, notifier, subscriptions, seen_posts, status, due, feeds):
+        """Scrape the due feeds concurrently; in worker mode only those this worker holds a lease on."""
+        leases = self.load_leases()
+        if leases is not None:
+            held = set(leases.balance([feed["url"] for feed in feeds]))
+            # Also resend what dead workers left in the outbox
+            await notifier.adopt_orphans(leases.alive_workers())
+            due = [feed for feed in due if feed["url"] in held]
+            if not due:
+                print(f"💤 Worker {self.worker_id} has no due feeds among its leases")
+                return {}
+        
+        # Started highest priority first, so those feeds get the fetch slots first
+        results = await asyncio.gather(*(
+            self.scrape_feed(feed, notifier, subscriptions, seen_posts, status) for feed in due
+        ))
+        return {feed["name"]: result for feed, result in zip(due, results)}
+    
+    def notify_config_changed(self):
+        """Start the next cycle right away with the updated models and settings."""
+        self.config_changed = True
+        self.scheduler.wake()
     
-    async def scraper_job(self, bot):
+    async def scraper_job(self, notifier):
         """Background job for periodic scraping."""
-        models = self.load_models()
+        subscriptions = self.load_subscriptions()
         seen_posts = self.load_seen_posts()
         status = self.load_status()
+        self.scheduler.wake_event.clear()
+        self.feed_due.clear()
+        self.config_changed = False
         
         print("\n" + "*"*50)
         print("🤖 SCRAPER BOT ACTIVATED 🤖")
-        print(f"Starting scraper with {len(models)} models to track")
+        print(f"Starting scraper with {sum(map(len, subscriptions.values()))} models "
+              f"to track for {len(subscriptions)} chats")
         print("*"*50)
+        self.rss_at_start = self.rss_at_start or self.process_memory()[0]
         
-        while self.running:
-            # Reload models each time to pick up any changes
-            models = self.load_models()
-            
-            if models:
-                print(f"\n🔄 Starting scraping cycle at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-                await self.scraper.scrape(bot, models, seen_posts, status)
-            else:
-                print("⚠️ No models to track. Skipping scraping.")
-            
-            # Exit if stopped
-            if not self.running:
-                break
+        try:
+            while self.running:
+                # Reload every chat's models and the feeds each time to pick up any changes
+                subscriptions = self.load_subscriptions()
+                feeds = self.load_feeds()
                 
-            # Wait for the next check interval
-            status = self.load_status()
-            print(f"\n⏱️ Waiting {status['check_interval']} seconds until next cycle")
-            try:
-                # Wait with regular checks for stop signal
-                for _ in range(status['check_interval']):
-                    if not self.running:
-                        break
-                    await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                break
-        
-        # Clean up resources
-        await self.scraper.close()
-        print("\n" + "*"*50)
-        print("🛑 SCRAPER BOT STOPPED 🛑")
-        print("*"*50)
+                # Drop seen posts past their TTL and rebuild the filter, off the event loop
+                if time.monotonic() >= self.compact_due and not (self.compact_task and not self.compact_task.done()):
+                    self.compact_due = time.monotonic() + SEEN_COMPACT_INTERVAL
+                    self.compact_task = asyncio.create_task(self.compact_seen_posts(seen_posts))
+                
+                now = time.monotonic()
+                due = [feed for feed in feeds if self.feed_due.get(feed["name"], 0) <= now]
+                if not subscriptions:
+                    print("⚠️ No models to track. Skipping scraping.")
+                elif due:
+                    print(f"\n🔄 Starting scraping cycle at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} "
+                          f"for {', '.join(feed['name'] for feed in due)}")
+                    with metrics.timer("cycle"):
+                        results = await self.run_cycle(notifier, subscriptions, seen_posts, status, due, feeds)
+                    if not all(success for success, _ in results.values()):
+                        metrics.error("cycle")
+                    metrics.increment("cycles")
+                    
+                    # Schedule every due feed's next fetch from its own listing rate and its priority
+                    now = time.monotonic()
+                    for feed in due:
+                        scheduler = self.feed_scheduler(feed, status["check_interval"])
+                        if feed["name"] in results:
+                            scheduler.record_cycle(*results[feed["name"]])
+                        interval = scheduler.next_interval() * PRIORITY_INTERVAL_FACTORS[feed["priority"]]
+                        if self.leases:
+                            # Scrape (and so rebalance) a feed well within its lease
+                            interval = min(interval, self.leases.ttl / 2)
+                        self.feed_due[feed["name"]] = now + interval
+                
+                # Exit if stopped
+                if not self.running:
+                    break
+                    
+                # Wait until the next feed is due
+                now = time.monotonic()
+                interval = max(1, min(
+                    (self.feed_due.get(feed["name"], 0) - now for feed in feeds), default=status["check_interval"]
+                ))
+                if not subscriptions:
+                    interval = status["check_interval"]
+                if self.leases:
+                    # Come back in time to renew the leases before they run out
+                    interval = min(interval, self.leases.ttl / 2)
+                print(f"\n⏱️ Waiting {interval:.0f} seconds until next cycle")
+                try:
+                    if await self.scheduler.wait(interval):
+                        print("⏩ Woken up early")
+                except asyncio.CancelledError:
+                    break
+                
+                # Settings are only re-read when they changed; a change makes every feed due
+                if self.config_changed:
+                    self.config_changed = False
+                    status = self.load_status()
+                    self.feed_due.clear()
+        finally:
+            # Clean up resources, also when the task is cancelled mid-cycle
+            await self.scraper.close()
+            print("\n" + "*"*50)
+            print("🛑 SCRAPER BOT STOPPED 🛑")
+            print("*"*50)
     
     async def start(self, bot):
         """Start the scraper."""
@@ -358,8 +3376,17 @@ class OLXScraperBot:
         # Reset scraper stop flag
         self.scraper.stop_requested = False
         
-        # Start scraper task
-        self.task = asyncio.create_task(self.scraper_job(bot))
+        self.load_price_history()
+        self.load_archive()
+        self.load_reposts()
+        
+        # Start the notification worker, then the scraper task
+        self.notifier = NotificationDispatcher(bot, self.load_seen_posts(), worker_id=self.worker_id)
+        self.notifier.start()
+        leases = self.load_leases()
+        if leases:
+            self.lease_task = asyncio.create_task(self.keep_leases(leases))
+        self.task = asyncio.create_task(self.scraper_job(self.notifier))
         
         # Update status
         status = self.load_status()
@@ -375,6 +3402,10 @@ class OLXScraperBot:
             
         self.running = False
         self.scraper.stop_requested = True
+        self.scheduler.wake()
+        
+        # Abort any in-flight page load instead of waiting for it
+        await self.scraper.close()
         
         # Cancel the task if it exists
         if self.task and not self.task.done():
@@ -384,10 +3415,29 @@ class OLXScraperBot:
             except (asyncio.CancelledError, asyncio.TimeoutError):
                 pass
         
+        # Flush queued notifications; undelivered ones stay in the outbox
+        if self.notifier:
+            await self.notifier.stop()
+        
+        # Let the other workers take the searches over right away
+        if self.lease_task:
+            self.lease_task.cancel()
+            self.lease_task = None
+        if self.leases:
+            self.leases.release_all()
+        
+        # Keep the seen filter so the next start doesn't rebuild it
+        if self.compact_task and not self.compact_task.done():
+            await self.compact_task
+        if self.seen_posts:
+            self.seen_posts.flush()
+            self.seen_posts.save_filter()
+        
         # Update status
         status = self.load_status()
         status["running"] = False
         self.save_status(status)
+        self.state.flush()
         
         return True
 
@@ -396,6 +3446,49 @@ class OLXScraperBot:
 scraper_bot = OLXScraperBot()
 
 
+def timed_handler(command, handler):
+    """Wrap a Telegram handler so its response latency is recorded."""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            scraper_bot.record_latency(command, time.perf_counter() - started)
+            if scraper_bot.first_response is None:
+                scraper_bot.first_response = time.monotonic() - STARTED_AT
+                print(f"🚀 First command answered {scraper_bot.first_response:.2f}s after start")
+    return wrapper
+
+
+async def on_ready(application):
+    """Report readiness and warm the browser up without delaying the first commands."""
+    scraper_bot.ready_after = time.monotonic() - STARTED_AT
+    print(f"✅ Bot ready for commands {scraper_bot.ready_after:.2f}s after start")
+    scraper_bot.warm_up_task = asyncio.create_task(scraper_bot.warm_up())
+
+
+def format_model(model):
+    """Human readable model entry with its filters."""
+    if isinstance(model, str):
+        return model
+    
+    filters = []
+    if "max_price" in model:
+        filters.append(f"Max: {model['max_price']} zł")
+    if "min_price" in model:
+        filters.append(f"Min: {model['min_price']} zł")
+    if model.get("exclude"):
+        filters.append(f"exclude: {', '.join(model['exclude'])}")
+    if model.get("locations"):
+        filters.append(f"in: {', '.join(model['locations'])}")
+    if model.get("storage"):
+        filters.append(f"storage: {'/'.join(str(size) for size in model['storage'])} GB")
+    
+    name = model.get("model", "")
+    return f"{name} ({'; '.join(filters)})" if filters else name
+
+
 # Command handlers
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send welcome message when the command /start is issued."""
@@ -405,10 +3498,16 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"I'm your iPhone OLX Scraper Bot. I'll help you track new iPhone listings on OLX.pl.\n\n"
         f"Commands you can use:\n"
         f"• /start - Show this welcome message\n"
-        f"• /add <model> [max_price] - Add an iPhone model to track (with optional price limit)\n"
+        f"• /add <model> [max_price] [filters] - Add an iPhone model to track (with optional price limit "
+        f"and min=, exclude=, city=, storage= filters)\n"
         f"• /delete - Delete a tracked model\n"
         f"• /list - Show all tracked models\n"
         f"• /status - Check the bot's status\n"
+        f"• /metrics - Show scrape stage timings\n"
+        f"• /stats [model] - Show listing prices per model\n"
+        f"• /memory - Show memory use and the seen posts' size\n"
+        f"• /subscribe - Track models of this chat's own (allowed chats only)\n"
+        f"• /unsubscribe - Stop this chat's own alerts\n"
         f"• /run - Start the scraper\n"
         f"• /stop - Stop the scraper\n\n"
         f"Let's start by adding an iPhone model to track using /add command!"
@@ -423,21 +3522,50 @@ async def add_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Please specify an iPhone model to track.\n"
             "Examples:\n"
             "• /add iPhone 13 Pro\n"
-            "• /add iPhone 11 500 (to set max price of 500 zł)"
+            "• /add iPhone 11 500 (to set max price of 500 zł)\n"
+            "• /add iPhone 12 1500 min=600 exclude=etui,szkło city=Warszawa storage=128,256"
         )
         return
     
-    models = scraper_bot.load_models()
+    chat_id = scraper_bot.command_chat(update.effective_chat.id)
+    models = scraper_bot.load_models(chat_id)
+    
+    # Split off key=value filters
+    args, filters = [], {}
+    for arg in context.args:
+        key, separator, value = arg.partition("=")
+        if separator and key.lower() in ("min", "max", "exclude", "city", "storage"):
+            filters[key.lower()] = value
+        else:
+            args.append(arg)
+    
+    if not args:
+        await update.message.reply_text("❌ Please specify the model name before the filters.")
+        return
     
     # Check if the last argument is a number (max price)
-    if len(context.args) > 1 and context.args[-1].isdigit():
-        max_price = int(context.args[-1])
-        model_name = ' '.join(context.args[:-1])
-        model_data = {"model": model_name, "max_price": max_price}
+    if len(args) > 1 and args[-1].isdigit():
+        model_name = ' '.join(args[:-1])
+        model_data = {"model": model_name, "max_price": int(args[-1])}
     else:
-        model_name = ' '.join(context.args)
+        model_name = ' '.join(args)
         model_data = {"model": model_name}
     
+    try:
+        if filters.get("max"):
+            model_data["max_price"] = int(filters["max"])
+        if filters.get("min"):
+            model_data["min_price"] = int(filters["min"])
+        if filters.get("exclude"):
+            model_data["exclude"] = [keyword.replace("_", " ") for keyword in filters["exclude"].split(",") if keyword]
+        if filters.get("city"):
+            model_data["locations"] = [city.replace("_", " ") for city in filters["city"].split(",") if city]
+        if filters.get("storage"):
+            model_data["storage"] = [int(size) for size in filters["storage"].lower().replace("gb", "").split(",") if size]
+    except ValueError:
+        await update.message.reply_text("❌ Prices and storage sizes must be whole numbers.")
+        return
+    
     # Check if model already exists
     for existing_model in models:
         if isinstance(existing_model, str) and existing_model == model_name:
@@ -448,34 +3576,29 @@ async def add_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Add the new model
     models.append(model_data)
     
-    if scraper_bot.save_models(models):
+    if scraper_bot.save_models(models, chat_id):
+        scraper_bot.notify_config_changed()
         # Update status file as well
-        status = scraper_bot.load_status()
-        status["models_tracked"] = models
-        scraper_bot.save_status(status)
+        scraper_bot.save_status(scraper_bot.load_status())
         
-        price_info = f" with max price {max_price} zł" if "max_price" in model_data else ""
-        await update.message.reply_text(f"✅ Added '{model_name}'{price_info} to tracked models.\nTotal models tracked: {len(models)}")
+        await update.message.reply_text(f"✅ Added '{format_model(model_data)}' to tracked models.\nTotal models tracked: {len(models)}")
     else:
         await update.message.reply_text("❌ Failed to add model. Please try again.")
 
 
 async def delete_model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete an iPhone model from tracking list."""
-    models = scraper_bot.load_models()
+    models = scraper_bot.load_models(scraper_bot.command_chat(update.effective_chat.id))
     if not models:
         await update.message.reply_text("No models are currently being tracked.")
         return
     
     keyboard = []
     for model in models:
+        display_name = format_model(model)
         if isinstance(model, str):
-            display_name = model
             callback_data = f"delete_{model}"
         else:
-            display_name = model.get("model", "")
-            if "max_price" in model:
-                display_name += f" (Max: {model['max_price']} zł)"
             callback_data = f"delete_{model['model']}"
         
         keyboard.append([InlineKeyboardButton(f"❌ {display_name}", callback_data=callback_data)])
@@ -486,7 +3609,7 @@ async def delete_model_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def list_models_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all tracked iPhone models."""
-    models = scraper_bot.load_models()
+    models = scraper_bot.load_models(scraper_bot.command_chat(update.effective_chat.id))
     
     if not models:
         await update.message.reply_text("No models are currently being tracked. Add one with /add command.")
@@ -494,14 +3617,7 @@ async def list_models_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     message = "📱 <b>Tracked iPhone Models:</b>\n\n"
     for i, model in enumerate(models, 1):
-        if isinstance(model, str):
-            message += f"{i}. {model}\n"
-        else:
-            model_name = model.get("model", "")
-            if "max_price" in model:
-                message += f"{i}. {model_name} (Max: {model['max_price']} zł)\n"
-            else:
-                message += f"{i}. {model_name}\n"
+        message += f"{i}. {format_model(model)}\n"
     
     message += f"\nTotal: {len(models)} models"
     
@@ -515,7 +3631,9 @@ async def list_models_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Check the bot's status."""
     status = scraper_bot.load_status()
-    models = scraper_bot.load_models()
+    models = scraper_bot.load_models(scraper_bot.command_chat(update.effective_chat.id))
+    subscriptions = scraper_bot.load_subscriptions()
+    feeds = ", ".join(f"{feed['name']} (priority {feed['priority']})" for feed in scraper_bot.load_feeds())
     
     status_emoji = "✅" if status["running"] else "❌"
     last_check = status["last_check"] if status["last_check"] else "Never"
@@ -526,9 +3644,24 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• <b>Last Check:</b> {last_check}\n"
         f"• <b>Check Interval:</b> {status['check_interval']} seconds\n"
         f"• <b>Total Posts Found:</b> {status['total_posts_found']}\n"
+        f"• <b>Unchanged Cycles Skipped:</b> {status.get('skipped_cycles', 0)}\n"
         f"• <b>Models Tracked:</b> {len(models)}\n"
+        f"• <b>Subscribed Chats:</b> {len(subscriptions)}\n"
+        f"• <b>Feeds:</b> {feeds}\n"
     )
     
+    if scraper_bot.ready_after is not None:
+        message += f"• <b>Startup:</b> ready after {scraper_bot.ready_after:.1f}s"
+        if scraper_bot.first_response is not None:
+            message += f", first reply after {scraper_bot.first_response:.1f}s"
+        message += "\n"
+    
+    latency = scraper_bot.latency_summary()
+    if latency:
+        message += "\n<b>⏱️ Response Latency (avg / max):</b>\n"
+        for command, (average_ms, max_ms) in sorted(latency.items()):
+            message += f"• {command}: {average_ms:.0f} / {max_ms:.0f} ms\n"
+    
     # Add control buttons
     keyboard = []
     if status["running"]:
@@ -543,11 +3676,97 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(message, parse_mode='HTML', reply_markup=reply_markup)
 
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show per-stage timings and counters of the scrape cycle."""
+    summary = metrics.summary()
+    counters = metrics.snapshot()[3]
+    if not summary and not counters:
+        await update.message.reply_text("No metrics yet. Start the scraper with /run.")
+        return
+    
+    message = "<b>📈 Stage Timings</b> (p50 / p95 / max ms)\n\n"
+    for stage, stats in summary.items():
+        if stats["p50"] is None:
+            timing = "no samples"
+        else:
+            timing = f"{stats['p50']:.0f} / {stats['p95']:.0f} / {stats['max']:.0f}"
+        message += f"• <b>{stage}:</b> {timing} ({stats['count']} runs, {stats['errors']} errors)\n"
+    
+    if counters:
+        message += "\n<b>🔢 Counters</b>\n\n"
+        for name, value in sorted(counters.items()):
+            message += f"• {name.replace('_', ' ')}: {value}\n"
+    
+    await update.message.reply_text(message, parse_mode='HTML')
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show listing prices per model over the price history window."""
+    query = " ".join(context.args) if context.args else None
+    stats = scraper_bot.load_price_history().stats(query)
+    if not stats:
+        await update.message.reply_text("No price history yet. Start the scraper with /run.")
+        return
+    
+    message = f"<b>📊 Prices over {PRICE_HISTORY_DAYS} days</b> (p10 / median / p90)\n\n"
+    for model, (count, p10, median, p90) in sorted(stats.items(), key=lambda item: -item[1][0])[:30]:
+        message += f"• <b>{model}:</b> {p10} / {median} / {p90} zł ({count} listings)\n"
+    
+    await update.message.reply_text(message, parse_mode='HTML')
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show process memory and the size of the seen-state, caches and indexes."""
+    report = scraper_bot.memory_report()
+    
+    def megabytes(value):
+        return f"{value / 2**20:.1f} MB" if value else "n/a"
+    
+    message = "<b>🧠 Memory</b>\n\n"
+    message += f"• <b>RSS:</b> {megabytes(report['rss'])} (peak {megabytes(report['peak'])}"
+    if report["rss_at_start"]:
+        message += f", {megabytes(report['rss_at_start'])} when the scraper started"
+    message += ")\n"
+    message += (f"• <b>Seen posts:</b> {report['seen_posts']} ({report['database_kb']:.0f} KB on disk), "
+                f"{report['outbox']} awaiting delivery\n")
+    message += (f"• <b>Seen filter:</b> {report['filter_keys']} keys in {report['filter_kb']:.0f} KB, "
+                f"{report['filter_fill']:.1%} full (~{report['filter_error_rate']:.4%} false positives)\n")
+    message += f"• <b>Last compaction:</b> {report['last_compaction'] or 'not yet'}\n"
+    message += f"• <b>Detail cache:</b> {report['detail_cache']} listings\n"
+    message += f"• <b>Repost index:</b> {report['repost_index']} listings\n"
+    message += f"• <b>Price history:</b> {report['price_history']} prices\n"
+    message += f"• <b>Metric samples:</b> {report['metric_samples']}\n"
+    
+    await update.message.reply_text(message, parse_mode='HTML')
+
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Let an allowed chat track models of its own and receive their alerts."""
+    chat_id = update.effective_chat.id
+    if str(chat_id) == str(CHAT_ID):
+        await update.message.reply_text("This chat already receives the alerts of the main model list.")
+    elif scraper_bot.subscribe(chat_id):
+        await update.message.reply_text(
+            "✅ Subscribed. /add, /list and /delete now manage this chat's own models and alerts come here."
+        )
+    else:
+        await update.message.reply_text(
+            f"❌ This chat may not subscribe. Ask the bot owner to add {chat_id} to SUBSCRIBER_CHAT_IDS."
+        )
+
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop a chat's own alerts and drop its models."""
+    if scraper_bot.unsubscribe(update.effective_chat.id):
+        scraper_bot.notify_config_changed()
+        await update.message.reply_text("✅ Unsubscribed. This chat's models were removed.")
+    else:
+        await update.message.reply_text("This chat is not subscribed.")
+
+
 async def run_bot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the scraper."""
-    models = scraper_bot.load_models()
-    
-    if not models:
+    if not scraper_bot.load_subscriptions():
         await update.message.reply_text("❌ No models to track. Add models first using /add command.")
         return
     
@@ -592,7 +3811,8 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith("delete_"):
         model_name = data[7:]  # Remove "delete_" prefix
-        models = scraper_bot.load_models()
+        chat_id = scraper_bot.command_chat(update.effective_chat.id)
+        models = scraper_bot.load_models(chat_id)
         
         # Find and remove the model
         removed = False
@@ -602,47 +3822,132 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 models.remove(model)
                 removed = True
         
-        if removed and scraper_bot.save_models(models):
+        if removed and scraper_bot.save_models(models, chat_id):
+            scraper_bot.notify_config_changed()
             # Update status file as well
-            status = scraper_bot.load_status()
-            status["models_tracked"] = models
-            scraper_bot.save_status(status)
+            scraper_bot.save_status(scraper_bot.load_status())
             
             await query.edit_message_text(f"✅ Removed '{model_name}' from tracked models.\nTotal models tracked: {len(models)}")
         else:
             await query.edit_message_text(f"❌ Failed to remove model. Please try again.")
 
 
+async def run_worker():
+    """Scrape and notify without handling commands; the main bot instance polls Telegram."""
+    bot = Bot(BOT_TOKEN)
+    await scraper_bot.start(bot)
+    print(f"Worker {scraper_bot.worker_id} started")
+    try:
+        await scraper_bot.task
+    finally:
+        await scraper_bot.stop()
+        scraper_bot.state.flush()
+
+
+def run_replay(directory, days=None, processes=None, verbose=False):
+    """Backtest the current models against the archived cycles."""
+    subscriptions = scraper_bot.load_subscriptions()
+    if not subscriptions:
+        print("❌ No models to replay. Add models first.")
+        return
+    if not directory or not os.path.isdir(directory):
+        print(f"❌ No archive at {directory}; set ARCHIVE_DIR and let the scraper record some cycles")
+        return
+    
+    since = time.time() - days * 86400 if days else None
+    tasks = ListingArchive(directory).tasks(since)
+    started = time.perf_counter()
+    checked, cycles, seen, counts = 0, 0, set(), {}
+    
+    # Chunks are streamed to the pool and their matches aggregated as they come back
+    with multiprocessing.Pool(processes, initializer=init_replay, initargs=(subscriptions,)) as pool:
+        for chunk_cycles, chunk_checked, matches in pool.imap(replay_chunk, tasks):
+            cycles += chunk_cycles
+            checked += chunk_checked
+            for chat_id, model, post_id, price, title, ts in matches:
+                # A listing stays on the page for several cycles
+                if (chat_id, post_id) in seen:
+                    continue
+                seen.add((chat_id, post_id))
+                counts[(chat_id, model)] = counts.get((chat_id, model), 0) + 1
+                if verbose:
+                    found_at = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+                    print(f"  {found_at} [{chat_id}] {model}: {title} - {price} zł")
+    
+    elapsed = time.perf_counter() - started
+    print("-"*50)
+    print(f"REPLAY SUMMARY ({elapsed:.1f}s, {checked / elapsed if elapsed else 0:.0f} posts/s):")
+    print(f"- Cycles replayed: {cycles}")
+    print(f"- Posts checked: {checked}")
+    for (chat_id, model), count in sorted(counts.items()):
+        print(f"- [{chat_id}] {model}: {count} matches")
+    print("-"*50)
+
+
 def main():
     """Run the bot."""
+    parser = argparse.ArgumentParser(description="OLX iPhone scraper bot")
+    parser.add_argument("--worker", metavar="ID", help="Run as a scraping worker sharing the searches with others")
+    parser.add_argument("--replay", action="store_true", help="Backtest the current models against the archive and exit")
+    parser.add_argument("--archive", default=ARCHIVE_DIR, metavar="DIR", help="Archive directory to replay")
+    parser.add_argument("--days", type=float, help="Only replay the last DAYS of the archive")
+    parser.add_argument("--processes", type=int, help="Replay worker processes (default: all cores)")
+    parser.add_argument("--verbose", action="store_true", help="Print every replayed match")
+    args = parser.parse_args()
+    if args.replay:
+        run_replay(args.archive, args.days, args.processes, args.verbose)
+        return
+    if args.worker:
+        scraper_bot.worker_id = args.worker
+        scraper_bot.state.files["status"] = OLXScraperBot.status_file(args.worker)
+    
     # Create necessary files if they don't exist
     if not os.path.exists(MODELS_FILE):
         JSONHandler.save(MODELS_FILE, [])
     
-    if not os.path.exists(SEEN_POSTS_FILE):
-        JSONHandler.save(SEEN_POSTS_FILE, {})
-    
     if not os.path.exists(STATUS_FILE):
         JSONHandler.save(STATUS_FILE, DEFAULT_STATUS)
     
+    # Optional Prometheus endpoint
+    if METRICS_PORT:
+        metrics.serve(METRICS_PORT)
+    
+    import_telegram()
+    
+    # Only one process may poll Telegram for commands; the others are headless workers
+    if args.worker:
+        try:
+            asyncio.run(run_worker())
+        except KeyboardInterrupt:
+            pass
+        return
+    
     # Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().token(BOT_TOKEN).post_init(on_ready).build()
     
     # Add command handlers
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("add", add_model_command))
-    application.add_handler(CommandHandler("delete", delete_model_command))
-    application.add_handler(CommandHandler("list", list_models_command))
-    application.add_handler(CommandHandler("status", status_command))
-    application.add_handler(CommandHandler("run", run_bot_command))
-    application.add_handler(CommandHandler("stop", stop_bot_command))
+    application.add_handler(CommandHandler("start", timed_handler("/start", start_command)))
+    application.add_handler(CommandHandler("add", timed_handler("/add", add_model_command)))
+    application.add_handler(CommandHandler("delete", timed_handler("/delete", delete_model_command)))
+    application.add_handler(CommandHandler("list", timed_handler("/list", list_models_command)))
+    application.add_handler(CommandHandler("status", timed_handler("/status", status_command)))
+    application.add_handler(CommandHandler("metrics", timed_handler("/metrics", metrics_command)))
+    application.add_handler(CommandHandler("stats", timed_handler("/stats", stats_command)))
+    application.add_handler(CommandHandler("memory", timed_handler("/memory", memory_command)))
+    application.add_handler(CommandHandler("subscribe", timed_handler("/subscribe", subscribe_command)))
+    application.add_handler(CommandHandler("unsubscribe", timed_handler("/unsubscribe", unsubscribe_command)))
+    application.add_handler(CommandHandler("run", timed_handler("/run", run_bot_command)))
+    application.add_handler(CommandHandler("stop", timed_handler("/stop", stop_bot_command)))
     
     # Add callback query handler
-    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(timed_handler("button", button_callback)))
     
     # Start the Bot - Updated for v20+ style
     print("Starting the bot...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
+    
+    # Write out state changes that are still waiting for the debounce delay
+    scraper_bot.state.flush()
 
 
 if __name__ == "__main__":
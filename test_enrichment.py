@@ -0,0 +1,56 @@
+"""Tests for the accessory and damage filters of DetailEnricher.
+
+Run with:
+    python -m pytest test_enrichment.py
+"""
+import unittest
+
+import scraper
+
+ACCESSORIES = [
+    "iPhone 13 case",
+    "Apple iPhone 13 Pro etui skórzane",
+    "iPhone 12 128GB folia ochronna",
+    "Etui do iPhone 13",
+    "Szkło hartowane iPhone 14 Pro",
+    "Ładowarka do iPhone z kablem",
+]
+
+PHONES_WITH_EXTRAS = [
+    "iPhone 13 128GB",
+    "iPhone 13 128GB + etui",
+    "iPhone 13 +etui, szkło hartowane i ładowarka",
+    "iPhone 13 z etui",
+    "iPhone 13 etui gratis",
+    "iPhone 13 128GB, w zestawie etui i ładowarka",
+    "iPhone 13 zawsze w etui",
+    "iPhone 13 bez etui",
+]
+
+
+def reason(title, description=""):
+    return scraper.DetailEnricher.rejection_reason({"title": title, "details": {"description": description}})
+
+
+class RejectionReasonTest(unittest.TestCase):
+
+    def test_accessories_are_rejected(self):
+        for title in ACCESSORIES:
+            with self.subTest(title=title):
+                self.assertTrue(reason(title).startswith("accessory"))
+
+    def test_phones_with_extras_are_kept(self):
+        for title in PHONES_WITH_EXTRAS:
+            with self.subTest(title=title):
+                self.assertIsNone(reason(title))
+
+    def test_damage(self):
+        self.assertEqual(reason("iPhone 13 zbity ekran"), "damaged (zbity)")
+        self.assertEqual(reason("iPhone 13", "Telefon nie działa"), "damaged (nie działa)")
+        self.assertIsNone(reason("iPhone 13 nieuszkodzony"))
+        self.assertIsNone(reason("iPhone 13", "Nigdy nie zbity, stan idealny"))
+        self.assertIsNone(reason("iPhone 13", "Bateria nie działa źle"))
+
+
+if __name__ == "__main__":
+    unittest.main()
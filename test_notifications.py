@@ -0,0 +1,163 @@
+"""Delivery tests for NotificationDispatcher against a fake Telegram bot.
+
+Run with:
+    python -m pytest test_notifications.py
+"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import scraper
+
+CHAT = "1"
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: raises the queued errors first, then records messages."""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.messages = []
+        self.attempts = 0
+
+    async def send_message(self, **kwargs):
+        self.attempts += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.messages.append(kwargs)
+
+
+def key(post_id):
+    """Seen-state key of a post notified to the test chat."""
+    return scraper.SeenPostsStore.key(post_id, CHAT)
+
+
+def record(post_id, title="iPhone 13 128GB"):
+    return {
+        "title": title,
+        "model": "iPhone 13",
+        "price": "2 000 zł",
+        "link": f"https://www.olx.pl/d/oferta/iphone-ID{post_id}.html",
+        "found_at": "2024-01-01 12:00:00"
+    }
+
+
+class NotificationDispatcherTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        scraper.import_telegram()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.store = scraper.SeenPostsStore(os.path.join(self.workdir.name, "seen.db"))
+        # No waiting between attempts or for the per-chat rate limit
+        patcher = mock.patch.multiple(
+            scraper, NOTIFICATION_BACKOFF=0, NOTIFICATION_REQUEUE_DELAY=0, CHAT_MESSAGES_PER_SECOND=1000
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.store.close()
+        self.workdir.cleanup()
+
+    async def deliver(self, bot, posts, digest_window=0):
+        """Submit posts to a started dispatcher and wait until its queue is drained."""
+        notifier = scraper.NotificationDispatcher(bot, self.store, chat_id=CHAT, digest_window=digest_window)
+        notifier.start()
+        for post_id in posts:
+            self.assertTrue(await notifier.submit(post_id, f"Listing {post_id}", record(post_id)))
+        await asyncio.wait_for(notifier.queue.join(), timeout=5)
+        await notifier.stop()
+        return notifier
+
+    async def test_retry_after_is_retried(self):
+        bot = FakeBot([scraper.RetryAfter(0)])
+        notifier = await self.deliver(bot, ["a1"])
+
+        self.assertEqual([message["text"] for message in bot.messages], ["Listing a1"])
+        self.assertEqual(notifier.sent, 1)
+        self.assertIn(key("a1"), self.store)
+        self.assertEqual(self.store.pending_notifications(), [])
+
+    async def test_bad_request_is_not_resent(self):
+        bot = FakeBot([scraper.BadRequest("Can't parse entities")])
+        notifier = await self.deliver(bot, ["b1"])
+
+        self.assertEqual(bot.messages, [])
+        self.assertEqual(notifier.failed, 1)
+        # Dropped from the outbox, so the rejected message isn't resent on every start
+        self.assertEqual(self.store.pending_notifications(), [])
+
+    async def test_transient_failures_are_requeued(self):
+        errors = [ConnectionError("network down")] * scraper.NOTIFICATION_MAX_RETRIES
+        bot = FakeBot(errors)
+        notifier = scraper.NotificationDispatcher(bot, self.store, chat_id=CHAT, digest_window=0)
+        notifier.start()
+        await notifier.submit("c1", "Listing c1", record("c1"))
+
+        for _ in range(100):
+            if bot.messages:
+                break
+            await asyncio.sleep(0.05)
+        await notifier.stop()
+
+        self.assertEqual(bot.attempts, scraper.NOTIFICATION_MAX_RETRIES + 1)
+        self.assertEqual([message["text"] for message in bot.messages], ["Listing c1"])
+        self.assertEqual(self.store.pending_notifications(), [])
+
+    async def test_digest_combines_a_burst(self):
+        bot = FakeBot()
+        await self.deliver(bot, ["d1", "d2", "d3"], digest_window=0.2)
+
+        self.assertEqual(len(bot.messages), 1)
+        self.assertIn("3 New iPhone Listings", bot.messages[0]["text"])
+        self.assertTrue(all(key(post_id) in self.store for post_id in ("d1", "d2", "d3")))
+
+    async def test_digest_escapes_html(self):
+        items = [{"record": record("e1", "iPhone 13 <nowy> & tani")}, {"record": record("e2")}]
+        digest = scraper.NotificationDispatcher.build_digest(items)
+
+        self.assertIn("iPhone 13 &lt;nowy&gt; &amp; tani", digest)
+        self.assertNotIn("<nowy>", digest)
+
+    async def test_alert_escapes_html(self):
+        submitted = []
+
+        class Notifier:
+            async def submit(self, post_id, message, record, chat_id=None):
+                submitted.append(message)
+                return True
+
+        workdir = self.workdir.name
+        state = scraper.StateStore(os.path.join(workdir, "models.json"), os.path.join(workdir, "status.json"))
+        olx = scraper.OLXScraper(fetch_backend="http", state=state)
+        post = dict(record("g1", "iPhone 13 <nowy> & tani"), id="g1", price_text="2 000 zł", max_price=None,
+                    location_time="Warszawa <centrum>", details={"condition": "Używany & sprawny"})
+        self.assertTrue(await olx.notify(Notifier(), post))
+        await olx.close()
+
+        self.assertIn("iPhone 13 &lt;nowy&gt; &amp; tani", submitted[0])
+        self.assertIn("Warszawa &lt;centrum&gt;", submitted[0])
+        self.assertIn("Używany &amp; sprawny", submitted[0])
+
+    async def test_outbox_is_resent_after_restart(self):
+        # Queued but never sent, as if the process died before delivery
+        crashed = scraper.NotificationDispatcher(FakeBot(), self.store, chat_id=CHAT)
+        self.assertTrue(await crashed.submit("f1", "Listing f1", record("f1")))
+        self.assertEqual([item["post_id"] for item in self.store.pending_notifications()], [key("f1")])
+
+        bot = FakeBot()
+        notifier = scraper.NotificationDispatcher(bot, self.store, chat_id=CHAT, digest_window=0)
+        notifier.start()
+        await asyncio.wait_for(notifier.queue.join(), timeout=5)
+        await notifier.stop()
+
+        self.assertEqual([message["text"] for message in bot.messages], ["Listing f1"])
+        self.assertEqual(self.store.pending_notifications(), [])
+        # Still deduplicated once delivered
+        self.assertFalse(await notifier.submit("f1", "Listing f1", record("f1")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for the adaptive polling rate and the new-listing counts it is fed.
+
+Run with:
+    python -m pytest test_scheduling.py
+"""
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import scraper
+
+ORGANIC_PER_MINUTE = 1.5
+
+
+def card(post_id, promoted=False):
+    featured = '<div data-testid="adCard-featured">Wyróżnione</div>' if promoted else ""
+    return (
+        f'<div data-cy="l-card" id="{post_id}">{featured}'
+        f'<a href="/d/oferta/iphone-ID{post_id}.html"><h6>iPhone 13 128GB</h6></a>'
+        f'<p data-testid="ad-price">2 000 zł</p>'
+        f'<p data-testid="location-date">Warszawa - Dzisiaj o 12:00</p>'
+        f'</div>'
+    )
+
+
+def page(organic_ids, promoted_count=4):
+    """Search page with promoted cards pinned above the organic ones, newest first."""
+    cards = [card(f"p{i}", promoted=True) for i in range(promoted_count)] + [card(i) for i in organic_ids]
+    return "<html><body>" + "\n".join(cards) + "</body></html>"
+
+
+class NewListingCountTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.pages = {"/search": page(range(10, 0, -1))}
+        self.server, url = benchmark.start_server(self.pages)
+        state = scraper.StateStore(
+            os.path.join(self.workdir.name, "models.json"), os.path.join(self.workdir.name, "status.json"),
+            write_delay=0
+        )
+        self.store = scraper.SeenPostsStore(os.path.join(self.workdir.name, "seen.db"))
+        self.olx = scraper.OLXScraper(base_url=url + "/search", fetch_backend="http", state=state,
+                                      enrich_details=False)
+        self.olx.fetch_posts_selenium = benchmark.selenium_disabled
+        self.notifier = scraper.NotificationDispatcher(benchmark.FakeBot(), self.store, chat_id="1")
+        self.status = json.loads(json.dumps(scraper.DEFAULT_STATUS))
+        self.shard = {"name": "search", "url": url + "/search", "watermark": {}, "fingerprint": None}
+
+    async def asyncTearDown(self):
+        await self.olx.close()
+        self.store.close()
+        self.server.shutdown()
+        self.workdir.cleanup()
+
+    async def scrape(self):
+        with benchmark.quiet():
+            self.assertTrue(await self.olx.scrape(self.notifier, ["iPhone 99"], self.store, self.status, self.shard))
+
+    async def test_promoted_cards_are_not_counted_as_organic(self):
+        await self.scrape()
+        self.assertEqual(self.shard["new_organic"], 10)
+
+        # One new listing under the same four promoted cards
+        self.pages["/search"] = page(range(11, 0, -1))
+        await self.scrape()
+        self.assertEqual(self.shard["new_posts"], 5)
+        self.assertEqual(self.shard["new_organic"], 1)
+
+
+class PollSchedulerTest(unittest.TestCase):
+
+    def simulate(self, promoted_per_cycle=0, cycles=40):
+        """Poll a feed getting ORGANIC_PER_MINUTE listings and return the final interval."""
+        clock = [1000.0]
+        with mock.patch.object(scraper.time, "monotonic", lambda: clock[0]), \
+                mock.patch.object(scraper, "POLL_JITTER", 0):
+            scheduler = scraper.PollScheduler(base_interval=120)
+            scheduler.record_cycle(True, 0)
+            backlog = 0.0
+            for _ in range(cycles):
+                interval = scheduler.next_interval()
+                clock[0] += interval
+                backlog += ORGANIC_PER_MINUTE * interval / 60
+                organic = int(backlog)
+                backlog -= organic
+                scheduler.record_cycle(True, organic + promoted_per_cycle)
+            return scheduler.next_interval()
+
+    def test_organic_rate_keeps_the_old_cadence(self):
+        self.assertAlmostEqual(self.simulate(), 120, delta=25)
+
+    def test_promoted_cards_would_force_the_minimum_interval(self):
+        # Why only organic listings may be recorded: four promoted cards per cycle
+        # would look like a busy feed and poll four times as often
+        self.assertEqual(self.simulate(promoted_per_cycle=4), scraper.MIN_CHECK_INTERVAL)
+
+
+if __name__ == "__main__":
+    unittest.main()